@@ -1,8 +1,21 @@
 # Запуск уведомления после run_polling
 async def on_startup(app):
-    if os.path.exists("restart_message.txt"):
-        with open("restart_message.txt", "r") as f:
-            user_id = int(f.read().strip())
+    # Первичная загрузка database/*.json (из снимка индексов, если он совпадает
+    # с файлами) и фоновое отслеживание изменений
+    from_snapshot = await load_index_snapshot()
+    await refresh_data_files()
+    if not from_snapshot:
+        await save_index_snapshot()
+    await photo_cache.load()
+    await run_io(mimetypes.init)
+    if Image is None:
+        logging.warning("⚠️ Pillow не установлен: картинки сохраняются без пережатия")
+    # Не через app.create_task: app.stop() дожидается таких задач, а эта бесконечная
+    background_tasks.add(asyncio.get_running_loop().create_task(watch_data_files(DATA_WATCH_INTERVAL)))
+
+    restart_message = await pop_text("restart_message.txt")
+    if restart_message is not None:
+        user_id = int(restart_message.strip())
         try:
             menu = [['📋 Сборки Warzone']]
             markup = ReplyKeyboardMarkup(menu, resize_keyboard=True)
@@ -10,49 +23,313 @@ async def on_startup(app):
                 chat_id=user_id,
                 text="✅ Бот успешно перезапущен. Возвращаюсь в главное меню...",
                 reply_markup=markup,
-                parse_mode="HTML"
+                parse_mode="HTML",
             )
         except Exception:
             logging.exception("❌ Не удалось отправить сообщение после рестарта")
-        os.remove("restart_message.txt")
 
+    if metrics_server is not None:
+        try:
+            await metrics_server.start()
+        except OSError as e:
+            logging.warning(f"⚠️ Эндпоинт метрик не запущен ({METRICS_LISTEN}:{METRICS_PORT}): {e}")
+
+    enable_io_guard()
+    logging.info(f"🚀 Готов к работе через {(time.monotonic() - PROCESS_STARTED) * 1000:.0f} мс после запуска"
+                 f" ({'индексы из снимка' if from_snapshot else 'полная загрузка данных'})")
+
+
+# Остановка фоновых задач после app.stop()
+async def on_shutdown(app):
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    background_tasks.clear()
+    if metrics_server is not None:
+        await metrics_server.stop()
+    # Изменения, ждущие групповой фиксации, должны попасть на диск до выхода
+    await build_repo.close()
+    # Сборки могли измениться за время работы — следующий запуск возьмёт свежий снимок
+    await save_index_snapshot()
+
+import abc
 import asyncio
 import sys
-import subprocess
 import logging
 import os
+import functools
+import hashlib
+import io
+import multiprocessing
+import mimetypes
+import contextvars
+import tempfile
+import sqlite3
+import time
+import bisect
+import copyreg
+import pickle
+import hmac
+import secrets
+import signal
+import itertools
+import atexit
+import html
+import queue
+import random
+from http import HTTPStatus
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from types import MappingProxyType
 from dotenv import load_dotenv
 load_dotenv()
-from logging.handlers import RotatingFileHandler
-from collections import Counter
-from datetime import datetime
+from logging.handlers import RotatingFileHandler, QueueHandler, QueueListener
+from collections import Counter, OrderedDict, deque
+from contextlib import AsyncExitStack
+from datetime import datetime, timedelta
+
+# Отсчёт для времени до первого ответа (импорт telegram и загрузка данных входят)
+PROCESS_STARTED = time.monotonic()
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Pillow не установлен — картинки хранятся без пережатия
+    Image = None
+
+
+# === Пул процессов для пережатия картинок ===
+# Создаётся до любых потоков (запись логов, пулы ввода-вывода и SQLite): fork
+# многопоточного процесса может оставить дочерний с захваченной чужим потоком
+# блокировкой. Поэтому же функция воркера объявлена здесь — дочерние процессы
+# видят модуль только в том виде, в каком он был в момент fork.
+IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", "1"))
+
+
+def _recompress_image(data: bytes, max_side: int, quality: int):
+    # Выполняется в отдельном процессе; None — пережатие не уменьшило файл
+    with Image.open(io.BytesIO(data)) as img:
+        img = ImageOps.exif_transpose(img)
+        img.thumbnail((max_side, max_side))
+        if img.mode not in ("RGB", "L"):
+            img = img.convert("RGB")
+        out = io.BytesIO()
+        img.save(out, "JPEG", quality=quality, optimize=True, progressive=True)
+    result = out.getvalue()
+    return result if len(result) < len(data) else None
+
+
+def _start_image_pool(workers: int):
+    if Image is None or workers < 1:
+        return None
+    # fork: воркеру не нужно заново импортировать бота. Все процессы пула
+    # форкаются на первой задаче, дальше пул новых не создаёт
+    pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("fork"))
+    pool.submit(int).result()
+    # Закрыть до разбора модулей при выходе, иначе менеджер пула ругается в stderr
+    atexit.register(pool.shutdown)
+    return pool
+
+
+image_pool = _start_image_pool(IMAGE_WORKERS)
 
 # Установка абсолютного пути к директории проекта
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 os.chdir(BASE_DIR)
 
 # === Логирование ===
+# Запись в файлы идёт в отдельном потоке (QueueListener): обработчики только
+# кладут запись в очередь. Последние записи дополнительно держатся в памяти для /log.
 os.makedirs("logs", exist_ok=True)
+LOG_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+LOG_BACKUP_COUNT = 3
+LOG_BUFFER_SIZE = int(os.getenv("LOG_BUFFER_SIZE", "2000"))
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+LOG_HANDLER_LEVELS = os.getenv("LOG_HANDLER_LEVELS", "")  # "get_type=debug,start=warning"
+LOG_SAMPLE = os.getenv("LOG_SAMPLE", "start=0.1")  # доля записываемых событий log_event: "событие=0.1,…"
+LOG_STRUCTURED = os.getenv("LOG_STRUCTURED", "kv")  # kv — key=value, json — одна JSON-строка на событие
+
+# Имя обработчика апдейта, в котором сделана запись (ставит timed_callback)
+current_handler = contextvars.ContextVar("current_handler", default="-")
+
+
+def parse_level(name: str) -> int:
+    level = logging.getLevelName(name.strip().upper())
+    if not isinstance(level, int):
+        raise ValueError(f"неизвестный уровень: {name}")
+    return level
+
+
+def parse_pairs(spec: str, convert) -> dict:
+    # "a=1,b=2" → {"a": convert("1"), "b": convert("2")}
+    pairs = {}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        key, sep, value = item.partition("=")
+        if not sep:
+            raise ValueError(f"ожидалось имя=значение: {item}")
+        pairs[key.strip()] = convert(value)
+    return pairs
+
+
+def parse_rate(value: str) -> float:
+    rate = float(value)
+    if not 0 <= rate <= 1:
+        raise ValueError(f"доля вне 0…1: {value}")
+    return rate
+
+
+class LogControl:
+    """Уровни логирования по обработчикам и выборка событий; меняются на лету через /loglevel и /logsample.
+
+    Уровень обработчика действует на все записи, сделанные внутри него (имя берётся
+    из current_handler), остальные записи фильтруются по уровню по умолчанию.
+    """
+
+    def __init__(self, default_level: int, handler_levels: dict, sample_rates: dict):
+        self.default_level = default_level
+        self.handler_levels = handler_levels
+        self.sample_rates = sample_rates
+
+    def level_for(self, handler: str) -> int:
+        return self.handler_levels.get(handler, self.default_level)
+
+    def enabled(self, level: int) -> bool:
+        """Стоит ли готовить запись уровня level в текущем обработчике (для дорогих дампов)."""
+        return level >= self.level_for(current_handler.get())
+
+    def apply(self):
+        # Корневой логгер пропускает самый подробный из настроенных уровней, остальное режет фильтр
+        logging.getLogger().setLevel(min([self.default_level, *self.handler_levels.values()]))
+
+    def set_handler_level(self, handler: str, level):
+        if handler == "*":
+            self.default_level = level if level is not None else parse_level(LOG_LEVEL)
+        elif level is None:
+            self.handler_levels.pop(handler, None)
+        else:
+            self.handler_levels[handler] = level
+        self.apply()
+
+    def set_sample_rate(self, event: str, rate):
+        if rate is None:
+            self.sample_rates.pop(event, None)
+        else:
+            self.sample_rates[event] = rate
+
+
+log_control = LogControl(parse_level(LOG_LEVEL), parse_pairs(LOG_HANDLER_LEVELS, parse_level), parse_pairs(LOG_SAMPLE, parse_rate))
+
+
+def log_event(event: str, level: int = logging.INFO, **fields):
+    """Структурированная запись: «событие key=value …» или JSON (LOG_STRUCTURED=json).
+
+    Ниже WARNING события проходят выборку LOG_SAMPLE; у прореженных в записи есть
+    sample=<доля>, чтобы по логу можно было оценить настоящее количество.
+    """
+    if not log_control.enabled(level):
+        return
+    if level < logging.WARNING:
+        rate = log_control.sample_rates.get(event, 1.0)
+        if rate < 1.0:
+            if random.random() >= rate:
+                return
+            fields["sample"] = rate
+    if LOG_STRUCTURED == "json":
+        message = json.dumps({"event": event, **fields}, ensure_ascii=False, default=str)
+    else:
+        message = " ".join([event, *(f"{key}={value!r}" if isinstance(value, str) else f"{key}={value}"
+                                     for key, value in fields.items())])
+    logging.log(level, message)
+
+
+class HandlerContextFilter(logging.Filter):
+    # Срабатывает в потоке, где пишут в лог, — там же доступен contextvar
+    def filter(self, record):
+        record.handler = current_handler.get()
+        return record.levelno >= log_control.level_for(record.handler)
+
+
+class RingBufferHandler(logging.Handler):
+    """Последние записи лога в памяти: /log отвечает без чтения файлов и journalctl."""
+
+    def __init__(self, capacity: int):
+        super().__init__()
+        self.records = deque(maxlen=capacity)
+
+    def emit(self, record):
+        # Вызывается под self.lock (Handler.handle); QueueHandler уже подставил аргументы и traceback в record.msg
+        self.records.append((record.created, record.levelno, getattr(record, "handler", "-"), record.getMessage()))
+
+    def tail(self, limit: int, min_level: int = logging.NOTSET, handler: str = None) -> list:
+        """Последние limit записей не ниже min_level (и только из обработчика handler, если задан)."""
+        with self.lock:
+            records = list(self.records)
+        matched = []
+        for entry in reversed(records):
+            if entry[1] >= min_level and (handler is None or entry[2] == handler):
+                matched.append(entry)
+                if len(matched) >= limit:
+                    break
+        matched.reverse()
+        return matched
+
+
+def tail_file(path: str, limit: int, block_size: int = 8192) -> list:
+    """Последние limit строк файла: чтение блоками с конца, без прохода по всему файлу."""
+    try:
+        f = open(path, "rb")
+    except FileNotFoundError:
+        return []
+    with f:
+        position = f.seek(0, os.SEEK_END)
+        data = b""
+        while position > 0 and data.count(b"\n") <= limit:
+            step = min(block_size, position)
+            position -= step
+            f.seek(position)
+            data = f.read(step) + data
+    lines = data.decode("utf-8", errors="replace").splitlines()
+    return lines[-limit:]
+
+
+def tail_log(path: str, limit: int) -> list:
+    # Не хватило строк в текущем файле — дочитываем ротированные path.1, path.2, …
+    lines = []
+    for n in range(LOG_BACKUP_COUNT + 1):
+        lines = tail_file(f"{path}.{n}" if n else path, limit - len(lines)) + lines
+        if len(lines) >= limit:
+            break
+    return lines
+
 
 # Обработчик для INFO и выше с ротацией
-info_handler = RotatingFileHandler("logs/info.log", maxBytes=1_000_000, backupCount=3, encoding="utf-8")
+info_handler = RotatingFileHandler("logs/info.log", maxBytes=1_000_000, backupCount=LOG_BACKUP_COUNT, encoding="utf-8")
 info_handler.setLevel(logging.INFO)
 info_handler.addFilter(lambda record: record.levelno < logging.WARNING)
 
 # Обработчик для WARNING и выше с ротацией
-error_handler = RotatingFileHandler("logs/error.log", maxBytes=1_000_000, backupCount=3, encoding="utf-8")
+error_handler = RotatingFileHandler("logs/error.log", maxBytes=1_000_000, backupCount=LOG_BACKUP_COUNT, encoding="utf-8")
 error_handler.setLevel(logging.WARNING)
 
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[info_handler, error_handler]  # Без StreamHandler
-)
+log_buffer = RingBufferHandler(LOG_BUFFER_SIZE)
+for _handler in (info_handler, error_handler):
+    _handler.setFormatter(logging.Formatter(LOG_FORMAT))
+
+log_queue = queue.SimpleQueue()
+queue_handler = QueueHandler(log_queue)
+queue_handler.setFormatter(logging.Formatter("%(message)s"))  # иначе basicConfig подставит "LEVEL:name:"
+queue_handler.addFilter(HandlerContextFilter())
+log_listener = QueueListener(log_queue, info_handler, error_handler, log_buffer, respect_handler_level=True)
+log_listener.start()
+atexit.register(log_listener.stop)  # дописать очередь в файлы при выходе
+
+logging.basicConfig(handlers=[queue_handler])  # Без StreamHandler
+log_control.apply()
 
 
 # === Импорты и конфигурация ===
-from telegram import Update, ReplyKeyboardMarkup, ReplyKeyboardRemove, InputFile, InlineKeyboardMarkup, InlineKeyboardButton
-from telegram.ext import ApplicationBuilder, CommandHandler, MessageHandler, ContextTypes, filters, ConversationHandler, CallbackQueryHandler
+from telegram import Update, ReplyKeyboardMarkup, ReplyKeyboardRemove, InputFile, InlineKeyboardMarkup, InlineKeyboardButton, InputMediaPhoto, Message
+from telegram.error import BadRequest, RetryAfter
+from telegram.ext import ApplicationBuilder, CommandHandler, MessageHandler, ContextTypes, filters, ConversationHandler, CallbackQueryHandler, BaseUpdateProcessor, TypeHandler, BaseRateLimiter, BasePersistence, PersistenceInput, BaseHandler
+from telegram.request import BaseRequest
 import json
 
 # === Константы ===
@@ -60,6 +337,1695 @@ TOKEN = os.getenv("BOT_TOKEN")
 ALLOWED_USERS = list(map(int, os.getenv("ALLOWED_USERS", "").split(",")))
 ADMIN_ID = int(os.getenv("ADMIN_ID"))
 DB_PATH = 'database/builds.json'
+FILE_ID_CACHE_PATH = 'database/file_ids.json'
+IMAGE_DIR = 'images'
+IMAGE_MAX_SIDE = int(os.getenv("IMAGE_MAX_SIDE", "1280"))
+IMAGE_QUALITY = int(os.getenv("IMAGE_QUALITY", "85"))
+IO_WORKERS = int(os.getenv("IO_WORKERS", "4"))
+IO_DEBUG = os.getenv("IO_DEBUG", "0") == "1"
+DATA_WATCH_INTERVAL = float(os.getenv("DATA_WATCH_INTERVAL", "5"))
+INDEX_SNAPSHOT_PATH = os.getenv("INDEX_SNAPSHOT_PATH", "database/index.snapshot")  # пусто — без снимка
+DB_COMMIT_WINDOW = float(os.getenv("DB_COMMIT_WINDOW", "0.05"))
+DB_PRETTY_JSON = os.getenv("DB_PRETTY_JSON", "0") == "1"
+STORAGE_MODE = os.getenv("STORAGE_MODE", "json")  # json | journal | sqlite
+SQLITE_PATH = 'database/builds.sqlite3'
+DB_JOURNAL_PATH = 'database/builds.journal.jsonl'
+DB_JOURNAL_COMPACT_AT = int(os.getenv("DB_JOURNAL_COMPACT_AT", "200"))
+UPDATE_CONCURRENCY = int(os.getenv("UPDATE_CONCURRENCY", "16"))
+MAX_PENDING_UPDATES = int(os.getenv("MAX_PENDING_UPDATES", "1024"))
+SHOW_ALL_PAGE_SIZE = int(os.getenv("SHOW_ALL_PAGE_SIZE", "10"))
+DELETE_PAGE_SIZE = int(os.getenv("DELETE_PAGE_SIZE", "5"))
+RENDER_CACHE_SIZE = int(os.getenv("RENDER_CACHE_SIZE", "1024"))
+BUILD_CAROUSEL = os.getenv("BUILD_CAROUSEL", "1") == "1"  # листание сборок правкой одного сообщения
+BOT_MODE = os.getenv("BOT_MODE", "polling")  # polling | webhook
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "127.0.0.1")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443"))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")  # публичный https-адрес для setWebhook, включая путь
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+WEBHOOK_MAX_BODY = 1024 * 1024
+# Bot API не вызывается — для стенда, прогона записанных апдейтов (--replay) и замеров
+TELEGRAM_OFFLINE = (os.getenv("TELEGRAM_OFFLINE", "0") == "1"
+                    or "--replay" in sys.argv or "--bench-routing" in sys.argv)
+UPDATE_RECORD_PATH = os.getenv("UPDATE_RECORD_PATH")  # запись входящих апдейтов в JSONL
+# Офлайн ограничивать некого: по умолчанию запросы идут без очереди
+RATE_LIMIT = os.getenv("RATE_LIMIT", "0" if TELEGRAM_OFFLINE else "1") == "1"
+RATE_GLOBAL = float(os.getenv("RATE_GLOBAL", "30"))  # сообщений в секунду на бота
+RATE_PER_CHAT = float(os.getenv("RATE_PER_CHAT", "1"))  # сообщений в секунду в один чат
+RATE_CHAT_BURST = int(os.getenv("RATE_CHAT_BURST", "8"))
+RATE_MAX_RETRIES = int(os.getenv("RATE_MAX_RETRIES", "3"))
+METRICS_LISTEN = os.getenv("METRICS_LISTEN", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9108"))  # 0 — без HTTP-эндпоинта /metrics
+PERSISTENCE_PATH = os.getenv("PERSISTENCE_PATH", "database/state.sqlite3")  # пусто — без сохранения сессий
+PERSISTENCE_INTERVAL = float(os.getenv("PERSISTENCE_INTERVAL", "10"))
+
+
+# === Неблокирующий ввод-вывод: файлы и JSON — в пуле потоков, systemd — через asyncio ===
+io_executor = ThreadPoolExecutor(max_workers=IO_WORKERS, thread_name_prefix="io")
+
+
+async def run_io(func, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(io_executor, functools.partial(func, *args, **kwargs))
+
+
+def file_stamp(path: str):
+    # (mtime, размер) файла или None, если файла нет
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return st.st_mtime_ns, st.st_size
+
+
+def _read_bytes(path: str):
+    try:
+        with open(path, 'rb') as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+
+def _write_text(path: str, text: str):
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(text)
+
+
+def _append_text(path: str, text: str):
+    with open(path, 'a', encoding='utf-8') as f:
+        f.write(text)
+
+
+def _pop_text(path: str):
+    # Прочитать и удалить файл-флаг; None, если его нет
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            text = f.read()
+    except FileNotFoundError:
+        return None
+    os.remove(path)
+    return text
+
+
+def write_bytes_atomic(path: str, data: bytes):
+    """Запись через временный файл + fsync + rename: файл либо старый, либо новый целиком."""
+    directory = os.path.dirname(path) or "."
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=f".{os.path.basename(path)}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    dir_fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)  # чтобы сам rename пережил сбой питания
+    finally:
+        os.close(dir_fd)
+    return file_stamp(path)
+
+
+def dump_json_bytes(data, pretty: bool = False) -> bytes:
+    if pretty:
+        return json.dumps(data, indent=2).encode('utf-8')
+    return json.dumps(data, separators=(",", ":")).encode('utf-8')
+
+
+def write_json_atomic(path: str, data, pretty: bool = False):
+    return write_bytes_atomic(path, dump_json_bytes(data, pretty))
+
+
+async def read_file(path: str):
+    return await run_io(_read_bytes, path)
+
+
+async def write_text(path: str, text: str):
+    await run_io(_write_text, path, text)
+
+
+async def pop_text(path: str):
+    return await run_io(_pop_text, path)
+
+
+async def run_command(*args: str, timeout: float = 10) -> tuple[int, str, str]:
+    with allow_blocking_io():
+        proc = await asyncio.create_subprocess_exec(
+            *args, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+        )
+    try:
+        stdout, stderr = await asyncio.wait_for(proc.communicate(), timeout)
+    except asyncio.TimeoutError:
+        proc.kill()
+        await proc.wait()
+        raise
+    return proc.returncode, stdout.decode(errors="replace"), stderr.decode(errors="replace")
+
+
+# IO_DEBUG=1: любой файловый/процессный вызов в потоке event loop — AssertionError.
+# Проверка включается после старта (on_startup), т.к. инициализация httpx/SSL читает файлы.
+_BLOCKING_IO_EVENTS = {
+    "open", "os.remove", "os.rename", "os.replace", "os.mkdir", "os.listdir",
+    "os.scandir", "shutil.copyfile", "shutil.rmtree", "subprocess.Popen",
+}
+_io_guard_active = False
+_blocking_io_allowed = contextvars.ContextVar("blocking_io_allowed", default=False)
+
+
+class allow_blocking_io:
+    # Явное разрешение (asyncio.create_subprocess_exec внутри вызывает Popen в потоке loop)
+    def __enter__(self):
+        self._token = _blocking_io_allowed.set(True)
+
+    def __exit__(self, *exc):
+        _blocking_io_allowed.reset(self._token)
+
+
+def _blocking_io_audit(event: str, args: tuple):
+    if not _io_guard_active or event not in _BLOCKING_IO_EVENTS or _blocking_io_allowed.get():
+        return
+    if event == "open" and isinstance(args[0], str) and args[0].endswith((".py", ".pyc")):
+        return  # ленивые импорты
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return  # не поток event loop
+    raise AssertionError(f"Блокирующий вызов в event loop: {event} {args[:2]!r}")
+
+
+def enable_io_guard():
+    global _io_guard_active
+    if not IO_DEBUG:
+        return
+    loop = asyncio.get_running_loop()
+    loop.set_debug(True)
+    loop.slow_callback_duration = 0.05
+    _io_guard_active = True
+    logging.warning("🧪 IO_DEBUG: блокирующие вызовы в event loop будут падать с AssertionError")
+
+
+if IO_DEBUG:
+    sys.addaudithook(_blocking_io_audit)
+
+
+# === Хранилище сборок: builds.json читается один раз на процесс ===
+def _freeze_build(build: dict) -> MappingProxyType:
+    frozen = dict(build)
+    frozen['modules'] = MappingProxyType(dict(build.get('modules', {})))
+    return MappingProxyType(frozen)
+
+
+def _thaw_build(build) -> dict:
+    thawed = dict(build)
+    thawed['modules'] = dict(build.get('modules', {}))
+    return thawed
+
+
+def _validate_builds(builds) -> None:
+    # Структурная проверка builds.json до выдачи ID и построения индексов
+    if not isinstance(builds, list):
+        raise ValueError("ожидается список сборок")
+    seen_ids = set()
+    for n, b in enumerate(builds, 1):
+        if not isinstance(b, dict):
+            raise ValueError(f"запись {n} не является объектом")
+        # Эти поля обработчики читают напрямую (build['type'], build['author'], …)
+        for field in ('weapon_name', 'mode', 'type'):
+            if not isinstance(b.get(field), str) or not b[field]:
+                raise ValueError(f"у записи {n} нет поля {field}")
+        if not isinstance(b.get('author'), str):
+            raise ValueError(f"у записи {n} нет поля author")
+        modules = b.get('modules')
+        if not isinstance(modules, dict):
+            raise ValueError(f"у записи {n} modules не объект")
+        if not all(isinstance(k, str) and isinstance(v, str) for k, v in modules.items()):
+            raise ValueError(f"у записи {n} в modules не строки")
+        if 'id' in b:
+            if type(b['id']) is not int or b['id'] in seen_ids:
+                raise ValueError(f"у записи {n} неверный или повторяющийся id {b['id']!r}")
+            seen_ids.add(b['id'])
+
+
+def _assign_build_ids(builds: list, next_id: int) -> tuple[int, int]:
+    # Сборкам без ID (записи до появления ID) выдаются следующие номера по порядку.
+    # next_id только растёт: ID удалённых сборок не выдаются повторно, иначе
+    # старые ссылки b<ID> и сохранённые в сессиях ID откроют чужую сборку.
+    next_id = max(next_id, max((b['id'] for b in builds if 'id' in b), default=0) + 1)
+    missing = 0
+    for b in builds:
+        if 'id' not in b:
+            b['id'] = next_id
+            next_id += 1
+            missing += 1
+    return missing, next_id
+
+
+def _read_next_id(path: str) -> int:
+    # {"next_id": N} рядом с builds.json; без файла счётчик берётся по сборкам
+    data = _read_bytes(path)
+    if data is None:
+        return 1
+    try:
+        next_id = json.loads(data).get('next_id', 1)
+    except (ValueError, AttributeError):
+        next_id = None
+    if type(next_id) is not int or next_id < 1:
+        logging.warning(f"⚠️ Неверный {path}, следующий ID считается по сборкам")
+        return 1
+    return next_id
+
+
+# === Фасетный индекс: режим → категория → тип → оружие → кол-во модулей ===
+class _FacetNode:
+    __slots__ = ('count', 'children', 'builds', 'sorted_keys')
+
+    def __init__(self):
+        self.count = 0
+        self.children = {}
+        self.builds = []
+        self.sorted_keys = None
+
+
+class FacetIndex:
+    """Вложенный индекс для пошагового просмотра сборок.
+
+    Каждый узел хранит количество сборок под ним, листья (кол-во модулей) —
+    список самих сборок. Каждый шаг просмотра — поиск по словарю, без обхода
+    всей базы. Индекс обновляется инкрементально при добавлении и удалении.
+
+    Отдельно хранятся отсортированные ID сборок — всех (ключ None) и по
+    режимам — для постраничных списков.
+    """
+
+    def __init__(self, builds=()):
+        self._root = _FacetNode()
+        self._ids = {None: []}
+        for b in builds:
+            self.add(b)
+
+    @staticmethod
+    def _path(build) -> tuple:
+        return (
+            build.get('mode', '').lower(),
+            build.get('category'),
+            build.get('type'),
+            build.get('weapon_name'),
+            len(build.get('modules', {})),
+        )
+
+    def _node(self, path):
+        node = self._root
+        for key in path:
+            node = node.children.get(key)
+            if node is None:
+                return None
+        return node
+
+    def add(self, build):
+        node = self._root
+        node.count += 1
+        for key in self._path(build):
+            node.sorted_keys = None
+            node = node.children.setdefault(key, _FacetNode())
+            node.count += 1
+        node.builds.append(build)
+        for ids in (self._ids[None], self._ids.setdefault(self._path(build)[0], [])):
+            bisect.insort(ids, build['id'])
+
+    def remove(self, build):
+        path = self._path(build)
+        nodes = [self._root]
+        for key in path:
+            child = nodes[-1].children.get(key)
+            if child is None:
+                return
+            nodes.append(child)
+        try:
+            nodes[-1].builds.remove(build)
+        except ValueError:
+            return
+        for node in nodes:
+            node.count -= 1
+        for ids in (self._ids[None], self._ids[path[0]]):
+            i = bisect.bisect_left(ids, build['id'])
+            if i < len(ids) and ids[i] == build['id']:
+                del ids[i]
+        # Убираем опустевшие ветки, чтобы они не попадали в кнопки
+        for parent, key, node in zip(nodes, path, nodes[1:]):
+            if not node.count:
+                del parent.children[key]
+                parent.sorted_keys = None
+                break
+
+    def count(self, *path) -> int:
+        node = self._node(path)
+        return node.count if node else 0
+
+    def keys(self, *path) -> list:
+        node = self._node(path)
+        if node is None:
+            return []
+        if node.sorted_keys is None:
+            node.sorted_keys = sorted(k for k in node.children if k is not None)
+        return node.sorted_keys
+
+    def types(self, mode: str) -> list:
+        # Типы режима по всем категориям сразу
+        node = self._node((mode,))
+        if node is None:
+            return []
+        return sorted({t for category in node.children.values() for t in category.children})
+
+    def builds(self, *path) -> list:
+        node = self._node(path)
+        return node.builds if node else []
+
+    def page(self, mode, after=None, before=None, limit: int = 10) -> tuple[list, bool, bool]:
+        # Страница ID после after (или перед before) и признаки соседних страниц
+        ids = self._ids.get(mode, [])
+        if before is not None:
+            end = bisect.bisect_left(ids, before)
+            start = max(0, end - limit)
+            end = min(len(ids), start + limit)
+        else:
+            start = bisect.bisect_right(ids, after) if after is not None else 0
+            end = start + limit
+        return ids[start:end], start > 0, end < len(ids)
+
+
+# === Репозиторий сборок: единый интерфейс для JSON и SQLite ===
+class BuildRepository(abc.ABC):
+    """Интерфейс хранилища сборок для обработчиков.
+
+    path — префикс фасетного пути (режим в нижнем регистре, категория, тип,
+    оружие, кол-во модулей), как в FacetIndex.
+    """
+
+    @abc.abstractmethod
+    async def refresh(self) -> bool:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def exists(self) -> bool:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def count(self, *path) -> int:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def keys(self, *path) -> list:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def types(self, mode: str) -> list:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def distinct_types(self) -> set:
+        """Все значения поля type по всем режимам."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def find(self, *path) -> tuple:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def find_ids(self, *path) -> tuple:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def get(self, build_id: int):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def page(self, mode: str = None, after: int = None, before: int = None,
+                   limit: int = 10) -> tuple[tuple, bool, bool]:
+        """Страница сборок по возрастанию ID: (сборки, есть_предыдущая, есть_следующая)."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def stats(self) -> dict:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def updated_at(self):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def add(self, build: dict) -> int:
+        """Сохраняет сборку и возвращает присвоенный ей ID."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def remove(self, build_id: int) -> bool:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def version(self) -> int:
+        """Счётчик изменений: растёт при каждом добавлении, удалении и перечитывании."""
+        raise NotImplementedError
+
+    async def close(self):
+        """Дописывает отложенные изменения перед выходом."""
+
+
+class BuildStore(BuildRepository):
+    """Кэш builds.json в памяти.
+
+    Обработчики получают неизменяемый снимок (кортеж сборок) без обращения к диску.
+    Файлы перечитываются в пуле потоков: фоновой проверкой mtime/размера
+    (watch_data_files), перед записью самим ботом и по /reload. Вместе со
+    снимком в том же потоке строятся фасетный индекс и индекс ID → сборка.
+
+    У каждой сборки постоянный числовой ID (поле "id"), выдаётся при добавлении.
+    Записям без ID при загрузке присваиваются следующие номера, и файл сразу
+    перезаписывается. Следующий свободный ID хранится в builds.meta.json рядом
+    с builds.json и в заголовке журнала, поэтому ID удалённых сборок не
+    используются повторно; сам builds.json остаётся списком сборок.
+
+    Изменения проходят через одного писателя: всё, что пришло за commit_window,
+    применяется и фиксируется за один раз. В обычном режиме — атомарной
+    перезаписью builds.json, в режиме журнала (journal_path) — дописыванием
+    записей add/remove в JSONL-журнал. Журнал накатывается на builds.json при
+    загрузке и сворачивается в новый builds.json, когда в нём накопится
+    compact_at записей.
+
+    Первая строка журнала — {"op": "base", "sha256": ..., "next_id": ...} снимка,
+    к которому он относится. Если builds.json уже другой (свёртка успела записать снимок, но
+    не обнулила журнал, или файл заменили вручную), журнал не накатывается.
+    """
+
+    def __init__(self, path: str, commit_window: float = 0.05, pretty: bool = False,
+                 journal_path: str = None, compact_at: int = 200):
+        self.path = path
+        self.meta_path = f"{os.path.splitext(path)[0]}.meta.json"
+        self.commit_window = commit_window
+        self.pretty = pretty
+        self.journal_path = journal_path
+        self.compact_at = compact_at
+        self._lock = asyncio.Lock()
+        self._builds: tuple = ()
+        self._by_id: dict = {}
+        self._next_id = 1
+        self._facets = FacetIndex()
+        self._stamp = None
+        self._snapshot_sha = None
+        self._journal_records = 0
+        self._unsaved_ids = 0
+        self._version = 0
+        self._mutations: asyncio.Queue = asyncio.Queue()
+        self._writer_task = None
+
+    # --- Чтение ---
+    def _current_stamp(self):
+        snapshot = file_stamp(self.path)
+        if not self.journal_path:
+            return snapshot
+        journal = file_stamp(self.journal_path)
+        return None if snapshot is None and journal is None else (snapshot, journal)
+
+    def _replay_journal(self, builds: list, snapshot_sha, next_id: int) -> tuple[list, int, int]:
+        try:
+            f = open(self.journal_path, 'r', encoding='utf-8')
+        except FileNotFoundError:
+            return builds, 0, next_id
+        records = 0
+        with f:
+            header = f.readline()
+            if not header.strip():
+                return builds, 0, next_id
+            header = json.loads(header)
+            if header.get('op') != 'base' or header.get('sha256') != snapshot_sha:
+                logging.warning("⚠️ Журнал относится к другой версии builds.json и не накатывается")
+                return builds, 0, next_id
+            next_id = max(next_id, header.get('next_id', 1))
+            for line in f:
+                if not line.strip():
+                    continue
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # Недописанная последняя строка после сбоя
+                    logging.warning("⚠️ Оборванная запись в конце журнала пропущена")
+                    break
+                if record['op'] == 'add':
+                    builds.append(record['build'])
+                    if 'id' in record['build']:
+                        # Удалённые позже сборки тоже двигают счётчик
+                        next_id = max(next_id, record['build']['id'] + 1)
+                elif 'id' in record:
+                    builds = [b for b in builds if b.get('id') != record['id']]
+                else:
+                    # Запись удаления из журнала до появления ID
+                    builds = [b for b in builds if b != record['build']]
+                records += 1
+        return builds, records, next_id
+
+    def _load(self, known_stamp):
+        # Выполняется в пуле потоков; None — файлы не менялись
+        stamp = self._current_stamp()
+        if stamp == known_stamp:
+            return None
+        builds, snapshot_sha, next_id = [], None, _read_next_id(self.meta_path)
+        data = _read_bytes(self.path)
+        if data is not None:
+            builds = json.loads(data)
+            snapshot_sha = hashlib.sha256(data).hexdigest()
+        journal_records = 0
+        if self.journal_path:
+            builds, journal_records, next_id = self._replay_journal(builds, snapshot_sha, next_id)
+        _validate_builds(builds)
+        missing_ids, next_id = _assign_build_ids(builds, next_id)
+        by_id = {b['id']: _freeze_build(b) for b in builds}
+        snapshot = tuple(by_id.values())
+        # Индекс строится здесь же, в пуле потоков: циклу событий остаётся подменить ссылки
+        return (stamp, by_id, snapshot, FacetIndex(snapshot), snapshot_sha, journal_records, missing_ids,
+                next_id)
+
+    def load_snapshot(self):
+        """Полное перечитывание для /reload (в пуле потоков), без учёта mtime."""
+        loaded = self._load(None)
+        if loaded is None:
+            # _load отдаёт None, когда ни снимка, ни журнала нет
+            raise ValueError(f"нет файла {self.path}")
+        return loaded
+
+    def swap(self, loaded):
+        """Подменяет снимок, индексы и счётчики разом, без await."""
+        (self._stamp, self._by_id, self._builds, self._facets,
+         self._snapshot_sha, self._journal_records, self._unsaved_ids, self._next_id) = loaded
+        self._version += 1
+
+    def state(self):
+        # То, что принимает swap(), — для снимка индексов; вызывать под self._lock
+        return (self._stamp, self._by_id, self._builds, self._facets,
+                self._snapshot_sha, self._journal_records, 0, self._next_id)
+
+    def snapshot_files(self) -> list:
+        return [self.path] + ([self.journal_path] if self.journal_path else [])
+
+    def restamp(self, state):
+        return (self._current_stamp(),) + state[1:]
+
+    async def save_assigned_ids(self):
+        # Вызывается под self._lock после swap: фиксирует на диске выданные при загрузке ID
+        if not self._unsaved_ids:
+            return
+        self._snapshot_sha = await run_io(self._write_snapshot, self._builds, self._next_id)
+        self._journal_records = 0
+        self._stamp = await run_io(self._current_stamp)
+        logging.info(f"🆔 Сборкам без ID присвоены номера: {self._unsaved_ids}")
+        self._unsaved_ids = 0
+
+    async def _refresh_locked(self) -> bool:
+        loaded = await run_io(self._load, self._stamp)
+        if loaded is None:
+            return False
+        self.swap(loaded)
+        logging.info(f"📦 builds.json загружен: {len(self._builds)} сборок"
+                     + (f", из журнала: {self._journal_records} записей" if self._journal_records else ""))
+        await self.save_assigned_ids()
+        return True
+
+    async def refresh(self) -> bool:
+        async with self._lock:
+            return await self._refresh_locked()
+
+    def exists(self) -> bool:
+        return self._stamp is not None
+
+    @property
+    def next_id(self) -> int:
+        """Следующий свободный ID (ID удалённых сборок сюда уже не вернутся)."""
+        return self._next_id
+
+    def mtime(self) -> float:
+        parts = self._stamp if self.journal_path else (self._stamp,)
+        return max(part[0] for part in parts if part) / 1e9
+
+    def snapshot(self) -> tuple:
+        return self._builds
+
+    # --- Запросы репозитория: всё из памяти ---
+    async def count(self, *path) -> int:
+        return self._facets.count(*path)
+
+    async def keys(self, *path) -> list:
+        return self._facets.keys(*path)
+
+    async def types(self, mode: str) -> list:
+        return self._facets.types(mode)
+
+    async def distinct_types(self) -> set:
+        return {b.get('type') for b in self._builds}
+
+    async def find(self, *path) -> tuple:
+        return tuple(self._facets.builds(*path))
+
+    async def find_ids(self, *path) -> tuple:
+        return tuple(b['id'] for b in self._facets.builds(*path))
+
+    async def get(self, build_id: int):
+        return self._by_id.get(build_id)
+
+    async def page(self, mode: str = None, after: int = None, before: int = None,
+                   limit: int = 10) -> tuple[tuple, bool, bool]:
+        ids, has_prev, has_next = self._facets.page(mode, after, before, limit)
+        return tuple(self._by_id[i] for i in ids), has_prev, has_next
+
+    async def stats(self) -> dict:
+        return {
+            "total": len(self._builds),
+            "authors": Counter(b.get("author", "—") for b in self._builds),
+            "categories": Counter(b.get("category", "—") for b in self._builds),
+        }
+
+    async def updated_at(self):
+        return self.mtime() if self.exists() else None
+
+    # --- Файлы ---
+    def _dump(self, builds: tuple, next_id: int):
+        # Счётчик пишется первым: после сбоя он может только опережать снимок
+        write_json_atomic(self.meta_path, {"next_id": next_id})
+        data = dump_json_bytes([_thaw_build(b) for b in builds], self.pretty)
+        write_bytes_atomic(self.path, data)
+        return hashlib.sha256(data).hexdigest()
+
+    def _journal_header(self, snapshot_sha, next_id: int) -> bytes:
+        return (json.dumps({"op": "base", "sha256": snapshot_sha, "next_id": next_id}) + "\n").encode('utf-8')
+
+    def _append_journal(self, records: list, snapshot_sha, next_id: int):
+        os.makedirs(os.path.dirname(self.journal_path), exist_ok=True)
+        with open(self.journal_path, 'ab') as f:
+            if f.tell() == 0:
+                f.write(self._journal_header(snapshot_sha, next_id))
+            f.write(b"".join((json.dumps(r, separators=(",", ":")) + "\n").encode('utf-8') for r in records))
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _compact_files(self, builds: tuple, next_id: int):
+        # Сначала новый снимок, потом пустой журнал с его хэшем: сбой между
+        # шагами оставит журнал со старым хэшем, и он просто не накатится
+        snapshot_sha = self._dump(builds, next_id)
+        write_bytes_atomic(self.journal_path, self._journal_header(snapshot_sha, next_id))
+        return snapshot_sha
+
+    def _write_snapshot(self, builds: tuple, next_id: int):
+        return self._compact_files(builds, next_id) if self.journal_path else self._dump(builds, next_id)
+
+    async def compact(self):
+        if not self.journal_path:
+            return
+        async with self._lock:
+            await self._refresh_locked()
+            records = self._journal_records
+            self._snapshot_sha = await run_io(self._compact_files, self._builds, self._next_id)
+            self._journal_records = 0
+            self._stamp = await run_io(self._current_stamp)
+        logging.info(f"🗜 Журнал свёрнут в builds.json ({records} записей)")
+
+    # --- Запись: единственный писатель с групповой фиксацией ---
+    def _ensure_writer(self):
+        if self._writer_task is None or self._writer_task.done():
+            self._writer_task = asyncio.get_running_loop().create_task(self._writer())
+
+    async def _mutate(self, op: str, payload):
+        future = asyncio.get_running_loop().create_future()
+        self._ensure_writer()
+        await self._mutations.put((op, payload, future))
+        return await future
+
+    async def _writer(self):
+        while True:
+            batch = [await self._mutations.get()]
+            try:
+                # Всё, что пришло за окно, фиксируется за один раз
+                await asyncio.sleep(self.commit_window)
+                while not self._mutations.empty():
+                    batch.append(self._mutations.get_nowait())
+                await self._write_batch(batch)
+            finally:
+                # close() ждёт через join(), пока очередь не опустеет
+                for _ in batch:
+                    self._mutations.task_done()
+
+    async def _write_batch(self, batch: list):
+        try:
+            await self._commit(batch)
+        except Exception as e:
+            logging.exception(f"❌ Не удалось записать сборки ({len(batch)} изменений)")
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        if self.journal_path and self._journal_records >= self.compact_at:
+            try:
+                await self.compact()
+            except Exception:
+                logging.exception("❌ Не удалось свернуть журнал")
+
+    async def close(self):
+        if self._writer_task is None:
+            return
+        if not self._writer_task.done():
+            await self._mutations.join()
+        self._writer_task.cancel()
+        await asyncio.gather(self._writer_task, return_exceptions=True)
+        self._writer_task = None
+
+    async def _commit(self, batch: list):
+        async with self._lock:
+            await self._refresh_locked()
+            by_id = dict(self._by_id)
+            next_id = self._next_id
+            facet_ops, records, results = [], [], []
+            for op, payload, _ in batch:
+                if op == "add":
+                    build = _freeze_build({**payload, "id": next_id})
+                    next_id += 1
+                    by_id[build['id']] = build
+                    facet_ops.append((op, build))
+                    records.append({"op": op, "build": _thaw_build(build)})
+                    results.append(build['id'])
+                else:
+                    build = by_id.pop(payload, None)
+                    if build is not None:
+                        facet_ops.append((op, build))
+                        records.append({"op": op, "id": payload})
+                    results.append(build is not None)
+
+            builds = tuple(by_id.values())
+            if self.journal_path:
+                if records:
+                    # ID добавленных сборок остаются в журнале и после их удаления
+                    await run_io(self._append_journal, records, self._snapshot_sha, self._next_id)
+                    self._journal_records += len(records)
+            else:
+                self._snapshot_sha = await run_io(self._dump, builds, next_id)
+            self._stamp = await run_io(self._current_stamp)
+            self._builds = builds
+            self._by_id = by_id
+            self._next_id = next_id
+            for op, b in facet_ops:
+                getattr(self._facets, op)(b)
+            if facet_ops:
+                self._version += 1
+
+        if len(batch) > 1:
+            logging.info(f"💾 {len(batch)} изменений сборок зафиксированы за один раз")
+        for (_, _, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+
+    async def add(self, build: dict) -> int:
+        return await self._mutate("add", build)
+
+    async def remove(self, build_id: int) -> bool:
+        return await self._mutate("remove", build_id)
+
+    def version(self) -> int:
+        return self._version
+
+
+class SqliteBuildRepository(BuildRepository):
+    """Сборки в SQLite (WAL) с индексом по фасетам.
+
+    Фильтрация идёт запросами по индексу (mode, category, type, weapon_name,
+    module_count), вся база в память не загружается. Все обращения к
+    соединению — в одном выделенном потоке.
+
+    id — AUTOINCREMENT: SQLite не выдаёт повторно ID удалённых сборок.
+    """
+
+    FACET_COLUMNS = ("mode", "category", "type", "weapon_name", "module_count")
+    BUILDS_TABLE = """
+        CREATE TABLE IF NOT EXISTS builds (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            mode TEXT NOT NULL,
+            category TEXT,
+            type TEXT,
+            weapon_name TEXT,
+            module_count INTEGER NOT NULL,
+            author TEXT,
+            data TEXT NOT NULL
+        );
+    """
+    SCHEMA = BUILDS_TABLE + """
+        CREATE INDEX IF NOT EXISTS builds_facets
+            ON builds (mode, category, type, weapon_name, module_count);
+        CREATE INDEX IF NOT EXISTS builds_mode ON builds (mode);
+        CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._conn = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite")
+        self._version = 0
+
+    async def _run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(func, *args))
+
+    def _connect(self) -> bool:
+        if self._conn is not None:
+            return False
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        conn = sqlite3.connect(self.path, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        self._upgrade_autoincrement(conn)
+        conn.executescript(self.SCHEMA)
+        self._conn = conn
+        logging.info(f"🗄 SQLite открыта: {self.path}")
+        return True
+
+    def _upgrade_autoincrement(self, conn):
+        # Базы, созданные до AUTOINCREMENT: таблица пересоздаётся один раз,
+        # счётчик sqlite_sequence начинается с наибольшего оставшегося ID
+        row = conn.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'builds'").fetchone()
+        if row is None or "AUTOINCREMENT" in row[0].upper():
+            return
+        conn.execute("BEGIN")
+        try:
+            conn.execute("ALTER TABLE builds RENAME TO builds_old")
+            conn.execute(self.BUILDS_TABLE)
+            conn.execute("INSERT INTO builds SELECT * FROM builds_old")
+            conn.execute("DROP TABLE builds_old")
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        logging.info("🗄 Таблица builds переведена на AUTOINCREMENT")
+
+    def _reserve_ids(self, next_id: int):
+        # ID ниже next_id считаются выданными (перенос из builds.json)
+        with self._conn:
+            updated = self._conn.execute(
+                "UPDATE sqlite_sequence SET seq = MAX(seq, ?) WHERE name = 'builds'", (next_id - 1,)).rowcount
+            if not updated:
+                self._conn.execute("INSERT INTO sqlite_sequence (name, seq) VALUES ('builds', ?)", (next_id - 1,))
+
+    async def refresh(self) -> bool:
+        return await self._run(self._connect)
+
+    def exists(self) -> bool:
+        return self._conn is not None
+
+    def _where(self, path: tuple) -> tuple[str, list]:
+        clauses = [f"{column} IS ?" for column in self.FACET_COLUMNS[:len(path)]]
+        return (" WHERE " + " AND ".join(clauses)) if clauses else "", list(path)
+
+    def _count(self, path: tuple) -> int:
+        where, params = self._where(path)
+        return self._conn.execute(f"SELECT COUNT(*) FROM builds{where}", params).fetchone()[0]
+
+    def _keys(self, path: tuple) -> list:
+        column = self.FACET_COLUMNS[len(path)]
+        where, params = self._where(path)
+        where += (" AND " if where else " WHERE ") + f"{column} IS NOT NULL"
+        rows = self._conn.execute(f"SELECT DISTINCT {column} FROM builds{where} ORDER BY {column}", params)
+        return [row[0] for row in rows]
+
+    def _distinct_types(self) -> set:
+        return {row[0] for row in self._conn.execute("SELECT DISTINCT type FROM builds")}
+
+    def _types(self, mode: str) -> list:
+        rows = self._conn.execute(
+            "SELECT DISTINCT type FROM builds WHERE mode = ? AND type IS NOT NULL ORDER BY type", (mode,))
+        return [row[0] for row in rows]
+
+    @staticmethod
+    def _row_build(build_id: int, data: str):
+        return _freeze_build({**json.loads(data), "id": build_id})
+
+    def _select(self, where: str, params: list) -> tuple:
+        rows = self._conn.execute(f"SELECT id, data FROM builds{where} ORDER BY id", params)
+        return tuple(self._row_build(*row) for row in rows)
+
+    def _get(self, build_id: int):
+        row = self._conn.execute("SELECT id, data FROM builds WHERE id = ?", (build_id,)).fetchone()
+        return self._row_build(*row) if row else None
+
+    def _find(self, path: tuple) -> tuple:
+        return self._select(*self._where(path))
+
+    def _find_ids(self, path: tuple) -> tuple:
+        where, params = self._where(path)
+        return tuple(row[0] for row in self._conn.execute(f"SELECT id FROM builds{where} ORDER BY id", params))
+
+    def _page(self, mode, after, before, limit) -> tuple[tuple, bool, bool]:
+        # Курсор по ID: индекс (mode) упорядочен по rowid, страница стоит O(limit)
+        where, params = self._where((mode,) if mode is not None else ())
+        joiner = " AND " if where else " WHERE "
+
+        def fetch(condition, value, order, count):
+            rows = self._conn.execute(
+                f"SELECT id, data FROM builds{where}{joiner}id {condition} ? ORDER BY id {order} LIMIT ?",
+                [*params, value, count]).fetchall()
+            return rows if order == "ASC" else rows[::-1]
+
+        if before is not None:
+            rows = fetch("<", before, "DESC", limit)
+            if len(rows) < limit:
+                # Начало списка: показываем полную первую страницу
+                rows = fetch(">", 0, "ASC", limit)
+        else:
+            rows = fetch(">", after or 0, "ASC", limit)
+        has_prev = bool(rows) and bool(fetch("<", rows[0][0], "DESC", 1))
+        has_next = bool(rows) and bool(fetch(">", rows[-1][0], "ASC", 1))
+        return tuple(self._row_build(*row) for row in rows), has_prev, has_next
+
+    def _stats(self) -> dict:
+        conn = self._conn
+        authors = Counter(dict(conn.execute("SELECT COALESCE(author, '—'), COUNT(*) FROM builds GROUP BY 1")))
+        categories = Counter(dict(conn.execute(
+            "SELECT COALESCE(category, '—'), COUNT(*) FROM builds GROUP BY 1 ORDER BY MIN(id)")))
+        return {"total": sum(authors.values()), "authors": authors, "categories": categories}
+
+    def _updated_at(self):
+        row = self._conn.execute("SELECT value FROM meta WHERE key = 'updated_at'").fetchone()
+        return float(row[0]) if row else None
+
+    def _touch(self):
+        self._conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('updated_at', ?)", (str(time.time()),))
+
+    def _insert_many(self, builds) -> list:
+        # ID сборки — первичный ключ; у новых сборок его выдаёт SQLite
+        ids = []
+        with self._conn:
+            for b in builds:
+                data = _thaw_build(b)
+                cursor = self._conn.execute(
+                    "INSERT INTO builds (id, mode, category, type, weapon_name, module_count, author, data) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    (data.pop("id", None), *FacetIndex._path(b), b.get("author"), json.dumps(data)),
+                )
+                ids.append(cursor.lastrowid)
+            self._touch()
+        return ids
+
+    def _remove(self, build_id: int) -> bool:
+        with self._conn:
+            removed = self._conn.execute("DELETE FROM builds WHERE id = ?", (build_id,)).rowcount
+            self._touch()
+        return removed > 0
+
+    async def count(self, *path) -> int:
+        return await self._run(self._count, path)
+
+    async def keys(self, *path) -> list:
+        return await self._run(self._keys, path)
+
+    async def types(self, mode: str) -> list:
+        return await self._run(self._types, mode)
+
+    async def distinct_types(self) -> set:
+        return await self._run(self._distinct_types)
+
+    async def find(self, *path) -> tuple:
+        return await self._run(self._find, path)
+
+    async def find_ids(self, *path) -> tuple:
+        return await self._run(self._find_ids, path)
+
+    async def get(self, build_id: int):
+        return await self._run(self._get, build_id)
+
+    async def page(self, mode: str = None, after: int = None, before: int = None,
+                   limit: int = 10) -> tuple[tuple, bool, bool]:
+        return await self._run(self._page, mode, after, before, limit)
+
+    async def stats(self) -> dict:
+        return await self._run(self._stats)
+
+    async def updated_at(self):
+        return await self._run(self._updated_at)
+
+    async def add(self, build: dict) -> int:
+        ids = await self._run(self._insert_many, [build])
+        self._version += 1
+        return ids[0]
+
+    async def remove(self, build_id: int) -> bool:
+        removed = await self._run(self._remove, build_id)
+        if removed:
+            self._version += 1
+        return removed
+
+    async def import_builds(self, builds, next_id: int) -> int:
+        """Переносит сборки с их ID и резервирует ID ниже next_id."""
+        ids = await self._run(self._insert_many, builds)
+        await self._run(self._reserve_ids, next_id)
+        self._version += 1
+        return len(ids)
+
+    def version(self) -> int:
+        return self._version
+
+
+def create_build_repository(mode: str) -> BuildRepository:
+    if mode == "sqlite":
+        return SqliteBuildRepository(SQLITE_PATH)
+    return BuildStore(
+        DB_PATH,
+        commit_window=DB_COMMIT_WINDOW,
+        pretty=DB_PRETTY_JSON,
+        journal_path=DB_JOURNAL_PATH if mode == "journal" else None,
+        compact_at=DB_JOURNAL_COMPACT_AT,
+    )
+
+
+build_repo = create_build_repository(STORAGE_MODE)
+
+
+# Разовый перенос builds.json (с учётом журнала) в SQLite: python bot2.py --migrate-sqlite
+async def migrate_json_to_sqlite() -> int:
+    source = BuildStore(DB_PATH, journal_path=DB_JOURNAL_PATH)
+    await source.refresh()
+    target = SqliteBuildRepository(SQLITE_PATH)
+    await target.refresh()
+    if await target.count():
+        raise SystemExit(f"❌ {SQLITE_PATH} уже содержит сборки — перенос отменён")
+    return await target.import_builds(source.snapshot(), source.next_id)
+
+
+# === Каталог модулей: modules-*.json читаются один раз и кэшируются ===
+MODULE_FILES = {
+    "assault": "modules-assault.json",
+    "battle": "modules-battle.json",
+    "smg": "modules-pp.json",
+    "shotgun": "modules-drobovik.json",
+    "marksman": "modules-pehotnay.json",
+    "lmg": "modules-pulemet.json",
+    "sniper": "modules-snayperki.json",
+    "pistol": "modules-pistolet.json",
+    "special": "modules-osoboe.json"
+}
+
+
+class ModuleSet:
+    """Модули одного типа оружия: варианты по слотам и готовые словари переводов."""
+    __slots__ = ('slots', 'en_to_ru', 'ru_to_en', 'stamp')
+
+    def __init__(self, raw: dict, stamp):
+        self.slots = {slot: tuple(MappingProxyType(dict(v)) for v in variants) for slot, variants in raw.items()}
+        self.en_to_ru = {v['en']: v['ru'] for variants in raw.values() for v in variants}
+        self.ru_to_en = {v['ru']: v['en'] for variants in raw.values() for v in variants}
+        self.stamp = stamp
+
+
+class ModuleCatalog:
+    """Кэш всех modules-*.json.
+
+    Каждый файл разбирается один раз в пуле потоков; при изменении
+    mtime/размера перечитывается только он. Поиск — только по памяти.
+    """
+
+    def __init__(self, directory: str, files: dict):
+        self.directory = directory
+        self.files = files
+        self._lock = asyncio.Lock()
+        self._sets: dict[str, ModuleSet] = {}
+        self._stamps: dict = {}
+        self._errors: dict[str, str] = {}
+        self.version = 0
+
+    def path(self, type_key: str):
+        filename = self.files.get(type_key)
+        return os.path.join(self.directory, filename) if filename else None
+
+    def _scan(self, known_stamps: dict) -> dict:
+        # Выполняется в пуле потоков: перечитывает только изменившиеся файлы
+        changes = {}
+        for type_key in self.files:
+            path = self.path(type_key)
+            stamp = file_stamp(path)
+            if type_key in known_stamps and stamp == known_stamps[type_key]:
+                continue
+            module_set, error = None, None
+            if stamp is not None:
+                try:
+                    with open(path, "r", encoding="utf-8") as f:
+                        module_set = ModuleSet(json.load(f), stamp)
+                except Exception as e:
+                    error = str(e)
+            changes[type_key] = (stamp, module_set, error)
+        return changes
+
+    async def refresh(self) -> bool:
+        async with self._lock:
+            changes = await run_io(self._scan, dict(self._stamps))
+            for type_key, (stamp, module_set, error) in changes.items():
+                self._stamps[type_key] = stamp
+                if error:
+                    # Оставляем прежний набор, чтобы модули не пропали из меню
+                    self._errors[type_key] = error
+                    logging.warning(f"❌ Не удалось загрузить {self.files[type_key]}: {error}")
+                    continue
+                self._errors.pop(type_key, None)
+                if module_set is None:
+                    self._sets.pop(type_key, None)
+                else:
+                    self._sets[type_key] = module_set
+                    logging.info(f"🧩 Загружен каталог модулей {self.files[type_key]}")
+            if changes:
+                self.version += 1
+            return bool(changes)
+
+    def load_snapshot(self) -> dict:
+        """Полное перечитывание для /reload (в пуле потоков): один битый файл отменяет всё."""
+        changes = self._scan({})
+        errors = [f"{self.files[k]}: {error}" for k, (_, _, error) in changes.items() if error]
+        if errors:
+            raise ValueError("; ".join(errors))
+        return changes
+
+    def swap(self, changes: dict):
+        self._stamps = {k: stamp for k, (stamp, _, _) in changes.items()}
+        self._sets = {k: module_set for k, (_, module_set, _) in changes.items() if module_set is not None}
+        self._errors = {k: error for k, (_, _, error) in changes.items() if error}
+        self.version += 1
+
+    def state(self) -> dict:
+        return {k: (self._stamps.get(k), self._sets.get(k), self._errors.get(k)) for k in self.files}
+
+    def snapshot_files(self) -> list:
+        return [self.path(k) for k in self.files]
+
+    def restamp(self, changes: dict) -> dict:
+        return {k: (file_stamp(self.path(k)), module_set, error) for k, (_, module_set, error) in changes.items()}
+
+    def loaded(self) -> list:
+        return sorted(self._sets)
+
+    def exists(self, type_key: str) -> bool:
+        return self._stamps.get(type_key) is not None
+
+    def error(self, type_key: str):
+        return self._errors.get(type_key)
+
+    def get(self, type_key: str):
+        """ModuleSet для типа или None, если файл не настроен/отсутствует/битый."""
+        return self._sets.get(type_key)
+
+    def translation(self, type_key: str) -> dict:
+        # EN → RU для отображения; пустой словарь, если модулей нет
+        module_set = self._sets.get(type_key)
+        return module_set.en_to_ru if module_set else {}
+
+    def variants(self, type_key: str, slot: str) -> tuple:
+        module_set = self._sets.get(type_key)
+        return module_set.slots.get(slot, ()) if module_set else ()
+
+
+module_catalog = ModuleCatalog("database", MODULE_FILES)
+
+
+# === Реестр типов оружия (types.json) ===
+class WeaponTypeRegistry:
+    """Кэш types.json с готовыми словарями key → label и label → key.
+
+    Файл перечитывается в пуле потоков только при изменении mtime/размера.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = asyncio.Lock()
+        self._stamp = None
+        self._types: tuple = ()
+        self._key_to_label: dict = {}
+        self._label_to_key: dict = {}
+        self.version = 0
+
+    def _load(self, known_stamp):
+        # Выполняется в пуле потоков; None — файл не менялся
+        stamp = file_stamp(self.path)
+        if stamp == known_stamp:
+            return None
+        types = ()
+        if stamp is not None:
+            with open(self.path, "r", encoding="utf-8") as f:
+                types = tuple(MappingProxyType(dict(t)) for t in json.load(f))
+        keys = set()
+        for n, t in enumerate(types, 1):
+            if not isinstance(t.get("key"), str) or not isinstance(t.get("label"), str):
+                raise ValueError(f"у записи {n} нет key или label")
+            if t["key"] in keys:
+                raise ValueError(f"key {t['key']!r} повторяется")
+            keys.add(t["key"])
+        return stamp, types
+
+    def load_snapshot(self):
+        """Полное перечитывание для /reload (в пуле потоков), без учёта mtime."""
+        return self._load(None)
+
+    def swap(self, loaded):
+        self._stamp, types = loaded
+        self._types = types
+        self._key_to_label = {t["key"]: t["label"] for t in types}
+        self._label_to_key = {t["label"]: t["key"] for t in types}
+        self.version += 1
+
+    def state(self):
+        return self._stamp, self._types
+
+    def snapshot_files(self) -> list:
+        return [self.path]
+
+    def restamp(self, state):
+        return file_stamp(self.path), state[1]
+
+    async def refresh(self) -> bool:
+        async with self._lock:
+            try:
+                loaded = await run_io(self._load, self._stamp)
+            except Exception as e:
+                # Оставляем прежние словари, чтобы подписи не пропали
+                logging.warning(f"❌ Не удалось загрузить types.json: {e}")
+                return False
+            if loaded is None:
+                return False
+            self.swap(loaded)
+            return True
+
+    def all(self) -> tuple:
+        return self._types
+
+    def label(self, type_key: str) -> str:
+        return self._key_to_label.get(type_key, type_key)
+
+    def key(self, label: str):
+        return self._label_to_key.get(label)
+
+    def label_to_key(self) -> dict:
+        return self._label_to_key
+
+
+weapon_types = WeaponTypeRegistry("database/types.json")
+
+
+# Фоновая проверка изменений database/*.json (stat и чтение — в пуле потоков)
+async def refresh_data_files():
+    for source in (build_repo, module_catalog, weapon_types):
+        try:
+            await source.refresh()
+        except Exception:
+            logging.exception(f"❌ Не удалось обновить {type(source).__name__}")
+
+
+def data_sources() -> dict:
+    """Источники данных в памяти: подменяются по /reload и попадают в снимок индексов."""
+    sources = {"types.json": weapon_types, "modules-*.json": module_catalog}
+    if isinstance(build_repo, BuildStore):
+        sources["builds.json"] = build_repo
+    return sources
+
+
+async def lock_sources(stack: AsyncExitStack, sources: dict):
+    # Под блокировками фоновая проверка и запись сборок ждут, пока мы закончим
+    for source in sources.values():
+        await stack.enter_async_context(source._lock)
+
+
+# === /reload: перечитать database/*.json без перезапуска ===
+async def reload_data() -> dict:
+    """Перечитывает types.json, modules-*.json и builds.json (кроме режима SQLite).
+
+    Файлы читаются, проверяются и индексируются в пуле потоков, обработчики тем
+    временем работают на прежних снимках. Если хоть один файл не прошёл
+    проверку — ValueError со списком ошибок, данные не меняются. Иначе снимки
+    подменяются подряд без await, и обработчик видит либо все старые данные,
+    либо все новые.
+    """
+    sources = data_sources()
+    async with AsyncExitStack() as stack:
+        await lock_sources(stack, sources)
+        started = time.perf_counter()
+        loaded = await asyncio.gather(*(run_io(source.load_snapshot) for source in sources.values()),
+                                      return_exceptions=True)
+        load_time = time.perf_counter() - started
+        errors = [f"{name}: {result}" for name, result in zip(sources, loaded) if isinstance(result, Exception)]
+        if errors:
+            raise ValueError("\n".join(errors))
+
+        swap_started = time.perf_counter()
+        for source, snapshot in zip(sources.values(), loaded):
+            source.swap(snapshot)
+        swap_time = time.perf_counter() - swap_started
+        if isinstance(build_repo, BuildStore):
+            await build_repo.save_assigned_ids()
+
+    labels = weapon_types.label_to_key()
+    # В режиме SQLite сборки в память не загружаются — только агрегаты
+    types = await build_repo.distinct_types()
+    return {
+        "builds": await build_repo.count(),
+        "types": len(weapon_types.all()),
+        "modules": [weapon_types.label(k) for k in module_catalog.loaded()],
+        "unknown_types": sorted({t or "—" for t in types if t not in labels}),
+        "load_ms": load_time * 1000,
+        "swap_ms": swap_time * 1000,
+        "total_ms": (time.perf_counter() - started) * 1000,
+    }
+
+
+# === Снимок индексов: холодный старт без разбора JSON и построения индексов ===
+INDEX_SNAPSHOT_MAGIC = b"NDIDX"
+INDEX_SNAPSHOT_VERSION = 2  # повышать при любом изменении FacetIndex, ModuleSet и состояний state()
+
+
+def _mapping_proxy(data: dict) -> MappingProxyType:
+    return MappingProxyType(data)
+
+
+def _reduce_mapping_proxy(proxy):
+    return _mapping_proxy, (dict(proxy),)
+
+
+# Замороженные сборки — MappingProxyType; pickle сохраняет общие ссылки
+# (одна и та же сборка в снимке, индексе ID и листе фасетов)
+copyreg.pickle(MappingProxyType, _reduce_mapping_proxy)
+
+
+def _index_snapshot_header() -> bytes:
+    return INDEX_SNAPSHOT_MAGIC + INDEX_SNAPSHOT_VERSION.to_bytes(2, "big")
+
+
+def _hash_files(paths) -> dict:
+    hashes = {}
+    for path in paths:
+        data = _read_bytes(path)
+        hashes[path] = hashlib.sha256(data).hexdigest() if data is not None else None
+    return hashes
+
+
+def _read_index_snapshot(path: str, sources: dict):
+    # В пуле потоков: (состояния, хэши) или (None, причина)
+    data = _read_bytes(path)
+    if data is None:
+        return None, "файла нет"
+    header = _index_snapshot_header()
+    if not data.startswith(header):
+        return None, "другая версия формата"
+    payload = pickle.loads(data[len(header):])
+    if payload["states"].keys() != sources.keys():
+        return None, "другой набор источников"
+    # mtime берём до хэшей: если файл поменяется между ними, фоновая проверка его перечитает
+    states = {name: source.restamp(payload["states"][name]) for name, source in sources.items()}
+    hashes = _hash_files(p for source in sources.values() for p in source.snapshot_files())
+    if hashes != payload["hashes"]:
+        return None, "исходные файлы изменились"
+    return states, hashes
+
+
+def _write_index_snapshot(path: str, sources: dict, states: dict):
+    # В пуле потоков: None, если файлы на диске новее состояния в памяти
+    if any(source.restamp(states[name]) != states[name] for name, source in sources.items()):
+        return None
+    hashes = _hash_files(p for source in sources.values() for p in source.snapshot_files())
+    payload = pickle.dumps({"states": states, "hashes": hashes}, protocol=pickle.HIGHEST_PROTOCOL)
+    write_bytes_atomic(path, _index_snapshot_header() + payload)
+    return hashes
+
+
+# Хэши исходных файлов, которым соответствует снимок на диске
+index_snapshot_hashes = None
+
+
+async def load_index_snapshot() -> bool:
+    """Подставляет индексы из INDEX_SNAPSHOT_PATH, если он построен по тем же файлам.
+
+    Файл пишет только сам бот, рядом с базой; формат — pickle с версией в
+    заголовке. При любой ошибке или несовпадении хэшей — False, и данные
+    собираются из JSON как обычно.
+    """
+    global index_snapshot_hashes
+    if not INDEX_SNAPSHOT_PATH:
+        return False
+    sources = data_sources()
+    started = time.perf_counter()
+    async with AsyncExitStack() as stack:
+        await lock_sources(stack, sources)
+        try:
+            states, detail = await run_io(_read_index_snapshot, INDEX_SNAPSHOT_PATH, sources)
+        except Exception as e:
+            logging.warning(f"⚠️ Снимок индексов не прочитан: {e}")
+            return False
+        if states is None:
+            logging.info(f"🗂 Снимок индексов не подходит ({detail}), полная загрузка")
+            return False
+        for name, source in sources.items():
+            source.swap(states[name])
+    index_snapshot_hashes = detail
+    logging.info(f"🗂 Индексы загружены из снимка за {(time.perf_counter() - started) * 1000:.1f} мс")
+    return True
+
+
+async def save_index_snapshot():
+    """Записывает снимок текущих индексов, если он устарел."""
+    global index_snapshot_hashes
+    if not INDEX_SNAPSHOT_PATH:
+        return
+    sources = data_sources()
+    async with AsyncExitStack() as stack:
+        await lock_sources(stack, sources)
+        if index_snapshot_hashes is not None:
+            current = await run_io(_hash_files, [p for source in sources.values() for p in source.snapshot_files()])
+            if current == index_snapshot_hashes:
+                return
+        states = {name: source.state() for name, source in sources.items()}
+        started = time.perf_counter()
+        try:
+            hashes = await run_io(_write_index_snapshot, INDEX_SNAPSHOT_PATH, sources, states)
+        except Exception:
+            logging.exception("❌ Не удалось записать снимок индексов")
+            return
+    if hashes is None:
+        logging.info("🗂 Файлы изменились во время записи снимка индексов, запишем в следующий раз")
+        return
+    index_snapshot_hashes = hashes
+    logging.info(f"🗂 Снимок индексов записан за {(time.perf_counter() - started) * 1000:.1f} мс")
+
+
+# Фоновые задачи процесса, отменяются в on_shutdown
+background_tasks: set = set()
+
+
+async def watch_data_files(interval: float):
+    while True:
+        await asyncio.sleep(interval)
+        await refresh_data_files()
+
+
+# === Кэш file_id Telegram для картинок сборок ===
+class PhotoFileIdCache:
+    """file_id загруженных в Telegram картинок по sha256 содержимого.
+
+    После первой загрузки картинка отправляется по file_id без повторной передачи
+    байтов. Кэш хранится рядом с builds.json ({хэш: {file_id, image}}).
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = asyncio.Lock()
+        self._entries: dict[str, dict] = {}
+        self._digests: dict[str, tuple] = {}  # путь → (stamp, sha256)
+
+    def _read(self) -> dict:
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    def _write(self, entries: dict):
+        write_json_atomic(self.path, entries)
+
+    async def load(self):
+        try:
+            self._entries = await run_io(self._read)
+        except Exception:
+            logging.exception("❌ Не удалось загрузить кэш file_id")
+
+    def _digest(self, path: str):
+        # Хэш пересчитывается только при изменении файла
+        stamp = file_stamp(path)
+        if stamp is None:
+            return None
+        cached = self._digests.get(path)
+        if cached and cached[0] == stamp:
+            return cached[1]
+        data = _read_bytes(path)
+        if data is None:
+            return None
+        digest = hashlib.sha256(data).hexdigest()
+        self._digests[path] = (stamp, digest)
+        return digest
+
+    async def digest(self, path: str):
+        return await run_io(self._digest, path)
+
+    def get(self, digest: str):
+        entry = self._entries.get(digest)
+        return entry['file_id'] if entry else None
+
+    async def _save(self):
+        await run_io(self._write, dict(self._entries))
+
+    async def put(self, digest: str, file_id: str, image: str):
+        async with self._lock:
+            self._entries[digest] = {'file_id': file_id, 'image': image}
+            await self._save()
+
+    async def drop(self, digest: str):
+        async with self._lock:
+            if self._entries.pop(digest, None) is not None:
+                await self._save()
+
+
+photo_cache = PhotoFileIdCache(FILE_ID_CACHE_PATH)
+
+
+# === Хранилище картинок по хэшу содержимого ===
+# Сигнатуры форматов, которые Telegram показывает как фото
+IMAGE_SIGNATURES = (
+    (b"\xff\xd8\xff", ".jpg"),
+    (b"\x89PNG\r\n\x1a\n", ".png"),
+    (b"GIF87a", ".gif"),
+    (b"GIF89a", ".gif"),
+)
+
+
+def image_extension(data: bytes):
+    # Расширение по первым байтам файла; None — формат не поддерживается
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return ".webp"
+    return next((ext for magic, ext in IMAGE_SIGNATURES if data.startswith(magic)), None)
+
+
+class ImageStore:
+    """Картинки сборок в images/<sha256>.<расширение>.
+
+    Имя — хэш исходной загрузки, поэтому одинаковые картинки не дублируются,
+    а сборки одного оружия больше не перезаписывают друг друга. На диск
+    кладётся уменьшенный и пережатый в JPEG вариант для показа; кодирование
+    идёт в пуле процессов (нужен Pillow, пул создаётся при импорте — см.
+    image_pool), event loop не занимает. Если пережать не вышло, сохраняется
+    оригинал с расширением по его настоящему формату; неизвестный формат
+    без пережатия не принимается (ValueError).
+    """
+
+    EXTENSIONS = (".jpg", ".png", ".webp", ".gif")
+
+    def __init__(self, directory: str, max_side: int, quality: int, pool):
+        self.directory = directory
+        self.max_side = max_side
+        self.quality = quality
+        self._pool = pool
+
+    def path(self, image_hash: str, ext: str = ".jpg") -> str:
+        return os.path.join(self.directory, f"{image_hash}{ext}")
+
+    def _find(self, image_hash: str):
+        # Уже сохранённая картинка с этим хэшем, в любом из форматов
+        for ext in self.EXTENSIONS:
+            path = self.path(image_hash, ext)
+            if os.path.exists(path):
+                return path
+        return None
+
+    async def _display_variant(self, data: bytes) -> bytes:
+        if self._pool is None:
+            return data
+        loop = asyncio.get_running_loop()
+        try:
+            result = await loop.run_in_executor(self._pool, _recompress_image, data, self.max_side, self.quality)
+        except Exception:
+            logging.exception("❌ Не удалось пережать изображение, сохраняем оригинал")
+            return data
+        return result or data
+
+    async def save(self, data: bytes) -> tuple[str, str]:
+        image_hash = await run_io(lambda: hashlib.sha256(data).hexdigest())
+        path = await run_io(self._find, image_hash)
+        if path:
+            logging.info(f"🖼️ Изображение уже есть: {path}")
+            return image_hash, path
+
+        display = await self._display_variant(data)
+        ext = image_extension(display)
+        if ext is None:
+            raise ValueError("неподдерживаемый формат изображения")
+        path = self.path(image_hash, ext)
+        await run_io(write_bytes_atomic, path, display)
+        logging.info(f"🖼️ Изображение сохранено: {path} ({len(data)} → {len(display)} байт)")
+        return image_hash, path
+
+
+image_store = ImageStore(IMAGE_DIR, IMAGE_MAX_SIDE, IMAGE_QUALITY, image_pool)
+
+
+def build_image_path(build) -> str:
+    # Новые сборки ссылаются на картинку по хэшу (расширение — из сохранённого пути), старые — по пути
+    image_hash = build.get('image_hash')
+    if not image_hash:
+        return build.get('image', '')
+    return image_store.path(image_hash, os.path.splitext(build.get('image', ''))[1] or ".jpg")
+
+
+# Ошибки Bot API, после которых сохранённый file_id больше не годится
+FILE_ID_ERRORS = ("file identifier", "file reference")
+
+
+async def deliver_build_photo(send, image_path: str):
+    """Отдаёт картинку сборки через send(photo): по file_id, если он есть, иначе загрузкой файла.
+
+    Возвращает результат send или None, если картинки на диске нет. «Message is
+    not modified» (повторное нажатие при правке) ошибкой не считается — True.
+    """
+    digest = await photo_cache.digest(image_path)
+    if digest is None:
+        return None
+
+    file_id = photo_cache.get(digest)
+    metrics.inc("bot_photo_file_id_total", result="hit" if file_id else "miss")
+    if file_id:
+        try:
+            return await send(file_id)
+        except BadRequest as e:
+            error = str(e).lower()
+            if "not modified" in error:
+                return True
+            if not any(marker in error for marker in FILE_ID_ERRORS):
+                raise
+            logging.warning(f"♻️ file_id для {image_path} отклонён ({e}), загружаем заново")
+            await photo_cache.drop(digest)
+
+    image = await read_file(image_path)
+    if image is None:
+        return None
+    sent = await send(InputFile(image, filename=os.path.basename(image_path)))
+    if isinstance(sent, Message) and sent.photo:
+        await photo_cache.put(digest, sent.photo[-1].file_id, image_path)
+    return sent
+
+
+async def reply_build_photo(message, image_path: str, **kwargs):
+    return await deliver_build_photo(lambda photo: message.reply_photo(photo=photo, **kwargs), image_path)
+
+
+async def edit_build_photo(message, image_path: str, caption: str, **kwargs):
+    # Подменяет фото и подпись в уже отправленном сообщении
+    return await deliver_build_photo(
+        lambda photo: message.edit_media(InputMediaPhoto(photo, caption=caption, parse_mode="HTML"), **kwargs),
+        image_path,
+    )
 
 
 # Этапы диалога для ConversationHandler
@@ -74,6 +2040,7 @@ def build_keyboard_with_main(buttons: list[list[str]]) -> ReplyKeyboardMarkup:
     return ReplyKeyboardMarkup(buttons, resize_keyboard=True)
 
 def admin_only(func):
+    @functools.wraps(func)
     async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
         user_id = update.effective_user.id
         if str(user_id) not in os.getenv("ALLOWED_USERS", "").split(","):
@@ -85,10 +2052,21 @@ def admin_only(func):
 
 # === Команда /start, главное меню ===
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    print("🔥 Новый код загружен с GitHub")
     user_id = update.effective_user.id
+    log_event("start", user=user_id)
     menu = get_main_menu(user_id)
 
+    # Ссылка на сборку: t.me/<бот>?start=b<ID>
+    build_id = parse_build_link(context.args)
+    if build_id is not None:
+        build = await build_repo.get(build_id)
+        if build is not None:
+            context.user_data['viewed_ids'] = (build['id'],)
+            context.user_data['current_index'] = 0
+            await send_build(update, context)
+            return
+        await update.message.reply_text("❌ Сборка по ссылке не найдена — возможно, её удалили.")
+
     if user_id in ALLOWED_USERS:
         text = "Добро пожаловать в NDsborki BOT"
         text += "\n\n🛠 Админ: используйте команду /add для добавления сборок."
@@ -109,6 +2087,17 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 
 
+# === Ссылки на сборки по ID ===
+def build_link(bot, build_id: int) -> str:
+    return f"https://t.me/{bot.username}?start=b{build_id}"
+
+
+def parse_build_link(args):
+    if args and args[0].startswith("b") and args[0][1:].isdigit():
+        return int(args[0][1:])
+    return None
+
+
 # === универсальная функция для клавиатуры === 
 def get_main_menu(user_id: int) -> ReplyKeyboardMarkup:
     return ReplyKeyboardMarkup([['📋 Сборки Warzone']], resize_keyboard=True)
@@ -117,24 +2106,9 @@ def get_main_menu(user_id: int) -> ReplyKeyboardMarkup:
 
 @admin_only
 async def check_files(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    import os
-
-    file_map = {
-        "assault": "modules-assault.json",
-        "battle": "modules-battle.json",
-        "smg": "modules-pp.json",
-        "shotgun": "modules-drobovik.json",
-        "marksman": "modules-pehotnay.json",
-        "lmg": "modules-pulemet.json",
-        "sniper": "modules-snayperki.json",
-        "pistol": "modules-pistolet.json",
-        "special": "modules-osoboe.json"
-    }
-
     msg_lines = ["🔍 Проверка файлов в /database:"]
-    for key, fname in file_map.items():
-        path = f"database/{fname}"
-        if os.path.exists(path):
+    for key, fname in module_catalog.files.items():
+        if module_catalog.exists(key):
             msg_lines.append(f"✅ {key}: <code>{fname}</code> — найден")
         else:
             msg_lines.append(f"❌ {key}: <code>{fname}</code> — отсутствует")
@@ -144,11 +2118,63 @@ async def check_files(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 
 
+# === Кэш готовых подписей и клавиатур просмотра ===
+def data_version() -> tuple:
+    return build_repo.version(), module_catalog.version, weapon_types.version
+
+
+class RenderCache:
+    """Готовые подписи и разметка просмотра с вытеснением LRU.
+
+    Ключ — то, от чего зависит результат: ID сборки, позиция в выдаче или
+    путь в фасетном индексе. Как только меняется версия данных (добавление,
+    удаление, перечитывание файлов, /reload), кэш сбрасывается целиком.
+    Объекты разметки PTB неизменяемы, поэтому одни и те же отдаются всем.
+    """
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._items: OrderedDict = OrderedDict()
+        self._version = None
+        self.hits = 0
+        self.misses = 0
+
+    def _sync(self):
+        version = data_version()
+        if version != self._version:
+            self._items.clear()
+            self._version = version
+
+    async def get(self, key, render):
+        """Значение по ключу; при промахе — результат render() (функции или корутины)."""
+        self._sync()
+        value = self._items.get(key)
+        if value is not None:
+            self._items.move_to_end(key)
+            self.hits += 1
+            return value
+        self.misses += 1
+        version = self._version
+        value = render()
+        if asyncio.iscoroutine(value):
+            value = await value
+        # Данные могли поменяться, пока render() ждал хранилище
+        if version == data_version():
+            self._items[key] = value
+            if len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+        return value
+
+    def stats(self) -> dict:
+        return {"size": len(self._items), "hits": self.hits, "misses": self.misses}
+
+
+render_cache = RenderCache(RENDER_CACHE_SIZE)
+
+
 # === Просмотр сборок по шагам ===
 async def show_all_builds(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    with open(DB_PATH, 'r') as f:
-        data = json.load(f)
-    types = sorted(set(b['type'] for b in data if b['mode'].lower() == 'warzone'))
+    types = await build_repo.types('warzone')
     if not types:
         await update.message.reply_text("Сборок Warzone пока нет.")
         return ConversationHandler.END
@@ -160,49 +2186,46 @@ async def show_all_builds(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def view_select_weapon(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     selected_label = update.message.text.strip()
-    label_to_key = context.user_data.get('label_to_key', {})
-    selected_key = label_to_key.get(selected_label, selected_label)
+    selected_key = weapon_types.key(selected_label) or selected_label
     context.user_data['selected_type'] = selected_key
 
+    category = context.user_data.get('selected_category')
 
-    with open(DB_PATH, 'r') as f:
-        data = json.load(f)
+    async def weapon_markup():
+        weapons = await build_repo.keys('warzone', category, selected_key)
+        # Пустой список кэшируется как False: None означает промах
+        return ReplyKeyboardMarkup([[w] for w in weapons], resize_keyboard=True) if weapons else False
 
-    weapons = sorted(set(
-        b['weapon_name'] for b in data
-        if b['type'] == selected_key and b.get('category') == context.user_data.get('selected_category')
-    ))
-
-    if not weapons:
+    markup = await render_cache.get(("weapons", category, selected_key), weapon_markup)
+    if not markup:
         await update.message.reply_text("Сборок по этому типу пока нет.")
         return ConversationHandler.END
 
-    context.user_data['available_weapons'] = weapons
-    buttons = [[w] for w in weapons]
-
-    await update.message.reply_text("Выберите оружие:", reply_markup=ReplyKeyboardMarkup(buttons, resize_keyboard=True))
+    await update.message.reply_text("Выберите оружие:", reply_markup=markup)
     return VIEW_SET_COUNT
 
+# Клавиатура «5 (N)» / «8 (N)» по фасетному индексу
+async def module_count_markup(context: ContextTypes.DEFAULT_TYPE) -> ReplyKeyboardMarkup:
+    path = ('warzone', context.user_data.get('selected_category'),
+            context.user_data['selected_type'], context.user_data['selected_weapon'])
+
+    async def render():
+        keyboard = [[f"{count} ({await build_repo.count(*path, count)})"] for count in (5, 8)]
+        if BUILD_CAROUSEL:
+            # Под фото карусели только inline-кнопки, выход к выбору остаётся здесь
+            keyboard.append(["📋 Сборки Warzone"])
+        return ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
+
+    return await render_cache.get(("counts", *path), render)
+
+
 # Просит выбрать количество модулей (5 или 8), с указанием количества доступных сборок
 async def view_set_count(update: Update, context: ContextTypes.DEFAULT_TYPE):
     context.user_data['selected_weapon'] = update.message.text  # ✅ фикс: сохраняем выбранное оружие
     context.user_data['selected_category'] = context.user_data.get('selected_category')
 
-    # Загружаем сборки из БД
-    with open(DB_PATH, 'r') as f:
-        builds = json.load(f)
-
-    # Считаем, сколько сборок с 5 и 8 модулями
-    count_5 = sum(1 for b in builds if b['weapon_name'] == context.user_data['selected_weapon']
-                                      and b['type'] == context.user_data['selected_type']
-                                      and len(b['modules']) == 5)
-    count_8 = sum(1 for b in builds if b['weapon_name'] == context.user_data['selected_weapon']
-                                      and b['type'] == context.user_data['selected_type']
-                                      and len(b['modules']) == 8)
-
     # Обновляем клавиатуру с количеством
-    keyboard = [[f"5 ({count_5})"], [f"8 ({count_8})"]]
-    await update.message.reply_text("Выберите количество модулей:", reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True))
+    await update.message.reply_text("Выберите количество модулей:", reply_markup=await module_count_markup(context))
 
     return VIEW_DISPLAY
 
@@ -220,45 +2243,50 @@ async def view_display_builds(update: Update, context: ContextTypes.DEFAULT_TYPE
 
     context.user_data['selected_count'] = count
 
-    with open(DB_PATH, 'r') as f:
-        builds = json.load(f)
-
-    filtered = [
-       b for b in builds
-       if b['type'] == context.user_data['selected_type'] and
-       b['weapon_name'] == context.user_data['selected_weapon'] and
-       len(b['modules']) == count and
-       b.get('category') == context.user_data.get('selected_category')
-     ]
-
-
+    filtered = await build_repo.find_ids(
+        'warzone',
+        context.user_data.get('selected_category'),
+        context.user_data['selected_type'],
+        context.user_data['selected_weapon'],
+        count,
+    )
 
     if not filtered:
         context.user_data.pop('selected_count', None)
-        # обновлённый пересчёт доступных сборок
-        count_5 = sum(1 for b in builds if b['weapon_name'] == context.user_data['selected_weapon'] and b['type'] == context.user_data['selected_type'] and len(b['modules']) == 5)
-        count_8 = sum(1 for b in builds if b['weapon_name'] == context.user_data['selected_weapon'] and b['type'] == context.user_data['selected_type'] and len(b['modules']) == 8)
-        keyboard = [[f"5 ({count_5})"], [f"8 ({count_8})"]]
         await update.message.reply_text(
             "❌ Подходящих сборок не найдено.\n\nВыберите другое количество модулей:",
-            reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
+            reply_markup=await module_count_markup(context)
         )
         return VIEW_DISPLAY
 
-    context.user_data['viewed_builds'] = filtered
+    # В сессии только ID; сами сборки берутся из общего хранилища при показе
+    context.user_data['viewed_ids'] = filtered
     context.user_data['current_index'] = 0
     return await send_build(update, context)
 
 
 
-# Показывает текущую сборку (с фото и навигацией)
-async def send_build(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def current_viewed_build(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Текущая сборка выдачи или None, если листать больше нечего."""
+    ids = context.user_data['viewed_ids']
     idx = context.user_data['current_index']
-    build = context.user_data['viewed_builds'][idx]
-
+    build = await build_repo.get(ids[idx])
+    while build is None:
+        # Сборку удалили, пока её листали — убираем из выдачи
+        ids = ids[:idx] + ids[idx + 1:]
+        context.user_data['viewed_ids'] = ids
+        if not ids:
+            await update.effective_message.reply_text("❌ Подходящих сборок больше нет.", reply_markup=get_main_menu(update.effective_user.id))
+            return None
+        idx = context.user_data['current_index'] = min(idx, len(ids) - 1)
+        build = await build_repo.get(ids[idx])
+    return build
+
+
+def build_caption(build) -> str:
     # Внешний вид вывода сборки (пользовательская часть)
     # Загружаем словарь переводов EN → RU
-    translation = load_translation_dict(build['type'])
+    translation = module_catalog.translation(build['type'])
 
     # Показываем сборку, переводя значения модулей
     modules_text = "\n".join(
@@ -266,38 +2294,122 @@ async def send_build(update: Update, context: ContextTypes.DEFAULT_TYPE):
         for k, v in build['modules'].items()
     )
 
-    caption = (
+    return (
         f"Оружие: {build['weapon_name']}\n"
         f"Дистанция: {build.get('role', '-')}\n"
-        f"Тип: {get_type_label_by_key(build['type'])}\n\n"
+        f"Тип: {weapon_types.label(build['type'])}\n\n"
         f"Модули: {len(build['modules'])}\n"
         f"{modules_text}\n\n"
         f"Автор: {build['author']}"
     )
 
 
+# === Карусель: ⬅/➡ под фото правят то же сообщение ===
+def carousel_keyboard(ids, idx: int) -> InlineKeyboardMarkup:
+    row = []
+    if idx > 0:
+        row.append(InlineKeyboardButton("⬅", callback_data=f"car:{idx - 1}:{ids[idx - 1]}"))
+    row.append(InlineKeyboardButton(f"{idx + 1}/{len(ids)}", callback_data="car:noop"))
+    if idx < len(ids) - 1:
+        row.append(InlineKeyboardButton("➡", callback_data=f"car:{idx + 1}:{ids[idx + 1]}"))
+    return InlineKeyboardMarkup([row])
+
 
+def reply_nav_keyboard(has_prev: bool, has_next: bool) -> ReplyKeyboardMarkup:
     nav = []
     nav_row = []
-    if idx > 0:
+    if has_prev:
         nav_row.append("⬅ Предыдущая")
-    if idx < len(context.user_data['viewed_builds']) - 1:
+    if has_next:
         nav_row.append("➡ Следующая")
     if nav_row:
         nav.append(nav_row)
     nav.append(["📋 Сборки Warzone"])
-    markup = ReplyKeyboardMarkup(nav, resize_keyboard=True)
+    return ReplyKeyboardMarkup(nav, resize_keyboard=True)
 
-    if os.path.exists(build['image']):
-        with open(build['image'], 'rb') as img:
-            await update.message.reply_photo(photo=InputFile(img), caption=caption, reply_markup=markup, parse_mode="HTML")
+
+async def build_view(ids, idx: int, build) -> tuple[str, object]:
+    """Подпись и навигация для сборки на позиции idx — из кэша, если уже строились."""
+    caption = await render_cache.get(("caption", build['id']), lambda: build_caption(build))
+    has_prev, has_next = idx > 0, idx < len(ids) - 1
+    if BUILD_CAROUSEL:
+        # Кнопки карусели зависят только от позиции и ID соседей
+        key = ("carousel", idx, len(ids), ids[idx - 1] if has_prev else None, ids[idx + 1] if has_next else None)
+        markup = await render_cache.get(key, lambda: carousel_keyboard(ids, idx))
     else:
-        await update.message.reply_text(caption, reply_markup=markup, parse_mode="HTML")
+        markup = await render_cache.get(("nav", has_prev, has_next), lambda: reply_nav_keyboard(has_prev, has_next))
+    return caption, markup
+
+
+async def prefetch_neighbours(ids, idx: int):
+    # Заранее достаём соседние сборки и хэши их картинок: при листании
+    # остаётся один stat файла и один запрос editMessageMedia по file_id
+    for i in (idx + 1, idx - 1):
+        if 0 <= i < len(ids):
+            build = await build_repo.get(ids[i])
+            if build is not None:
+                await photo_cache.digest(build_image_path(build))
+
+
+def schedule_prefetch(context: ContextTypes.DEFAULT_TYPE):
+    context.application.create_task(
+        prefetch_neighbours(context.user_data['viewed_ids'], context.user_data['current_index']))
+
+
+# Показывает текущую сборку (с фото и навигацией)
+async def send_build(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    build = await current_viewed_build(update, context)
+    if build is None:
+        return VIEW_DISPLAY
+    caption, markup = await build_view(context.user_data['viewed_ids'], context.user_data['current_index'], build)
+
+    message = update.effective_message
+    sent = await reply_build_photo(message, build_image_path(build), caption=caption, reply_markup=markup, parse_mode="HTML")
+    if sent is None:
+        await message.reply_text(caption, reply_markup=markup, parse_mode="HTML")
+    if BUILD_CAROUSEL:
+        schedule_prefetch(context)
     return VIEW_DISPLAY
 
+
+async def carousel_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    if query.data == "car:noop":
+        await query.answer()
+        return
+    _, idx, build_id = query.data.split(":")
+    idx, build_id = int(idx), int(build_id)
+
+    ids = context.user_data.get('viewed_ids', ())
+    # Старое сообщение может прийти как InaccessibleMessage (или с нулевой датой) — править нечего
+    accessible = isinstance(query.message, Message) and query.message.is_accessible
+    if not accessible or idx >= len(ids) or ids[idx] != build_id:
+        await query.answer("⚠️ Эта подборка устарела — выберите сборки заново.", show_alert=True)
+        return
+    await query.answer()
+
+    context.user_data['current_index'] = idx
+    build = await current_viewed_build(update, context)
+    if build is None:
+        return
+    caption, markup = await build_view(context.user_data['viewed_ids'], context.user_data['current_index'], build)
+    image_path = build_image_path(build)
+
+    edited = None
+    if query.message.photo:
+        edited = await edit_build_photo(query.message, image_path, caption, reply_markup=markup)
+    elif await photo_cache.digest(image_path) is None:
+        edited = await query.edit_message_text(caption, reply_markup=markup, parse_mode="HTML")
+    if edited is None:
+        # Фото ↔ текст: правкой тип сообщения не сменить, отправляем новое
+        await send_build(update, context)
+        return
+    schedule_prefetch(context)
+
+
 # Переход к следующей сборке
 async def next_build(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if context.user_data['current_index'] < len(context.user_data['viewed_builds']) - 1:
+    if context.user_data['current_index'] < len(context.user_data['viewed_ids']) - 1:
         context.user_data['current_index'] += 1
         return await send_build(update, context)
 
@@ -348,26 +2460,11 @@ async def get_category(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def get_mode(update: Update, context: ContextTypes.DEFAULT_TYPE):
     context.user_data['mode'] = update.message.text
 
-    # Загружаем weapon_types
-    weapon_types = load_weapon_types()
-    key_to_label = {item["key"]: item["label"] for item in weapon_types}
-
-    # Загружаем сборки
-    with open(DB_PATH, 'r', encoding='utf-8') as f:
-        data = json.load(f)
-
-    # Фильтруем по режиму и категории
-    available_keys = sorted(set(
-        b['type'] for b in data
-        if b.get("mode", "").lower() == context.user_data['mode'].lower()
-        and b.get("category") == context.user_data.get("category")
-    ))
-
-    # Сохраняем соответствие key → label
-    context.user_data['type_map'] = {key: key_to_label.get(key, key) for key in available_keys}
+    # Типы по режиму и категории из фасетного индекса
+    available_keys = await build_repo.keys(context.user_data['mode'].lower(), context.user_data.get("category"))
 
     # Строим кнопки с label
-    labels = list(context.user_data['type_map'].values())
+    labels = [weapon_types.label(key) for key in available_keys]
     buttons = [labels[i:i+2] for i in range(0, len(labels), 2)]
 
     await update.message.reply_text("Выберите тип оружия:", reply_markup=ReplyKeyboardMarkup(buttons, resize_keyboard=True))
@@ -375,28 +2472,17 @@ async def get_mode(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 
 
-# === Функция для загрузки типов === 
-def load_weapon_types():
-    with open("database/types.json", "r", encoding="utf-8") as f:
-        return json.load(f)
-
-
 # === Выбор количества модулей (по key) ===
 async def get_type(update: Update, context: ContextTypes.DEFAULT_TYPE):
     selected_label = update.message.text.strip()
-    weapon_types = load_weapon_types()
-
     # Мапа: label → key
-    label_to_key = {item["label"]: item["key"] for item in weapon_types}
+    label_to_key = weapon_types.label_to_key()
     selected_key = label_to_key.get(selected_label)
 
-    # Логируем, что ввёл пользователь
-    logging.info(f"[get_type] Введён label: {selected_label!r}")
-
-    # Логируем все доступные варианты
-    logging.info("[get_type] Все доступные label → key:")
-    for label, key in label_to_key.items():
-        logging.info(f" - {label!r} → {key}")
+    log_event("type_selected", label=selected_label, key=selected_key)
+    # Полный список label → key — только при включённом DEBUG для get_type
+    if log_control.enabled(logging.DEBUG):
+        log_event("type_labels", logging.DEBUG, labels=dict(label_to_key))
 
     if not selected_key:
         await update.message.reply_text("❌ Тип оружия не распознан. Пожалуйста, выберите из предложенных кнопок.")
@@ -404,34 +2490,17 @@ async def get_type(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     context.user_data['type'] = selected_key
 
-    file_map = {
-        "assault": "modules-assault.json",
-        "battle": "modules-battle.json",
-        "smg": "modules-pp.json",
-        "shotgun": "modules-drobovik.json",
-        "marksman": "modules-pehotnay.json",
-        "lmg": "modules-pulemet.json",
-        "sniper": "modules-snayperki.json",
-        "pistol": "modules-pistolet.json",
-        "special": "modules-osoboe.json"
-    }
-
-    filename = file_map.get(selected_key)
-    if not filename:
+    if selected_key not in module_catalog.files:
         await update.message.reply_text("❌ Для выбранного типа оружия модули пока не настроены.")
         return ConversationHandler.END
 
-    try:
-        with open(f"database/{filename}", "r", encoding="utf-8") as f:
-            module_data = json.load(f)
-    except Exception as e:
-        logging.exception(f"❌ Ошибка при загрузке файла {filename}")
-        await update.message.reply_text(f"❌ Не удалось загрузить модули для {selected_label}.\nОшибка: {e}")
+    module_set = module_catalog.get(selected_key)
+    if module_set is None:
+        error = module_catalog.error(selected_key) or f"файл {module_catalog.files[selected_key]} отсутствует"
+        logging.error(f"❌ Ошибка при загрузке файла {module_catalog.files[selected_key]}: {error}")
+        await update.message.reply_text(f"❌ Не удалось загрузить модули для {selected_label}.\nОшибка: {error}")
         return ConversationHandler.END
 
-    context.user_data['module_variants'] = module_data
-    context.user_data['module_options'] = list(module_data.keys())
-
     await update.message.reply_text(
         "Сколько модулей:",
         reply_markup=ReplyKeyboardMarkup([["5"], ["8"]], resize_keyboard=True)
@@ -441,12 +2510,19 @@ async def get_type(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 
 
+# Слоты модулей выбранного типа — из общего каталога, не из сессии
+def module_slots(context: ContextTypes.DEFAULT_TYPE) -> list:
+    module_set = module_catalog.get(context.user_data['type'])
+    return list(module_set.slots) if module_set else []
+
+
 # Запрашивает выбор количество модулей (5 или 8)
 async def get_module_count(update: Update, context: ContextTypes.DEFAULT_TYPE):
     context.user_data['module_count'] = int(update.message.text)
     context.user_data['selected_modules'] = []
     context.user_data['detailed_modules'] = {}
-    buttons = [context.user_data['module_options'][i:i+2] for i in range(0, len(context.user_data['module_options']), 2)]
+    options = module_slots(context)
+    buttons = [options[i:i+2] for i in range(0, len(options), 2)]
     await update.message.reply_text("Выберите модуль:", reply_markup=ReplyKeyboardMarkup(buttons, resize_keyboard=True))
     return MODULE_SELECT
 
@@ -457,8 +2533,12 @@ async def module_variant_callback(update: Update, context: ContextTypes.DEFAULT_
     if 'current_module' not in context.user_data:
         await query.message.reply_text("⚠️ Ошибка: модуль не выбран.")
         return MODULE_SELECT
-    variant = query.data
+    variant = query.data.removeprefix("mod:")
     current_module = context.user_data['current_module']
+    # Кнопка со старой клавиатуры другого слота
+    if variant not in {v['en'] for v in module_catalog.variants(context.user_data['type'], current_module)}:
+        await query.message.reply_text(f"⚠️ Выберите вариант для {current_module} из последнего списка.")
+        return MODULE_SELECT
     context.user_data['detailed_modules'][current_module] = variant
 
     if current_module not in context.user_data['selected_modules']:
@@ -471,7 +2551,7 @@ async def module_variant_callback(update: Update, context: ContextTypes.DEFAULT_
         await query.edit_message_reply_markup(reply_markup=None)
         context.user_data.pop('current_module', None)  # Сбросим текущий модуль
         context.user_data['waiting_image'] = True
-        logging.info("✅ Все модули выбраны, переходим к загрузке изображения.")
+        log_event("modules_selected", logging.DEBUG, count=len(context.user_data['selected_modules']))
         await query.message.reply_text(
             "📷 Все модули выбраны.\nТеперь прикрепите изображение сборки (фото или файл):",
             reply_markup=ReplyKeyboardRemove()
@@ -479,7 +2559,7 @@ async def module_variant_callback(update: Update, context: ContextTypes.DEFAULT_
         return IMAGE_UPLOAD
 
     # Если не все модули выбраны — предлагаем выбрать следующий
-    remaining = [m for m in context.user_data['module_options'] if m not in context.user_data['selected_modules']]
+    remaining = [m for m in module_slots(context) if m not in context.user_data['selected_modules']]
     buttons = [remaining[i:i+2] for i in range(0, len(remaining), 2)]
     context.user_data['current_module'] = None
     await query.edit_message_reply_markup(reply_markup=None)
@@ -490,19 +2570,14 @@ async def module_variant_callback(update: Update, context: ContextTypes.DEFAULT_
 # === Выбор модуля через обычные кнопки, варианты — inline ===
 async def select_modules(update: Update, context: ContextTypes.DEFAULT_TYPE):
     module = update.message.text
-    if module not in context.user_data['module_options'] or module in context.user_data['selected_modules']:
+    if module not in module_slots(context) or module in context.user_data['selected_modules']:
         await update.message.reply_text("Некорректный или уже выбранный модуль.")
         return MODULE_SELECT
 
     context.user_data['current_module'] = module
-    variants = context.user_data['module_variants'].get(module, [])
-
-    # Сохраняем перевод EN → RU
-    context.user_data['variant_translation'] = {
-        v['en']: v['ru'] for v in variants
-    }
+    variants = module_catalog.variants(context.user_data['type'], module)
 
-    keyboard = [[InlineKeyboardButton(v['en'], callback_data=v['en'])] for v in variants]
+    keyboard = [[InlineKeyboardButton(v['en'], callback_data=f"mod:{v['en']}")] for v in variants]
 
     await update.message.reply_text(
         f"Выберите вариант для {module}:",
@@ -518,28 +2593,36 @@ async def reject_early_image(update: Update, context: ContextTypes.DEFAULT_TYPE)
 # === Загрузка изображения ===
 
 async def handle_image(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    logging.info("📥 Обработка изображения началась...")
-
     file = None
 
     if update.message.photo:
-        logging.info("📷 Получено сжатое фото")
+        source = "photo"
         file = await update.message.photo[-1].get_file()
     elif update.message.document and update.message.document.mime_type.startswith("image/"):
-        logging.info("🖼️ Получен несжатый документ-изображение")
+        source = "document"
         file = await update.message.document.get_file()
     else:
         logging.warning("❌ Изображение не распознано")
         await update.message.reply_text("❌ Пожалуйста, прикрепите изображение как фото или как файл.")
         return IMAGE_UPLOAD
 
-    os.makedirs("images", exist_ok=True)
-    path = f"images/{context.user_data['weapon'].replace(' ', '_')}.jpg"
-    await file.download_to_drive(path)
+    image = await file.download_as_bytearray()
+    try:
+        image_hash, path = await image_store.save(bytes(image))
+    except ValueError:
+        logging.warning(f"❌ Неподдерживаемый формат изображения ({source})")
+        await update.message.reply_text("❌ Этот формат не поддерживается. Пришлите картинку в JPEG, PNG, WebP или GIF.")
+        return IMAGE_UPLOAD
     context.user_data['image'] = path
+    context.user_data['image_hash'] = image_hash
+
+    # Сжатое фото уже лежит в Telegram — его file_id можно отправлять сразу
+    if update.message.photo:
+        digest = await photo_cache.digest(path)
+        if digest and not photo_cache.get(digest):
+            await photo_cache.put(digest, update.message.photo[-1].file_id, path)
 
-    logging.info(f"✅ Изображение сохранено: {path}")
-    logging.info("⏳ Ожидание подтверждения...")
+    log_event("image_received", source=source, bytes=len(image), path=path)
 
     await update.message.reply_text(
         "✅ Изображение получено.\n\nНажмите «Завершить», чтобы сохранить сборку, или «Отмена», чтобы прервать.",
@@ -559,18 +2642,11 @@ async def confirm_build(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "type": context.user_data['type'],
         "modules": context.user_data['detailed_modules'],
         "image": context.user_data['image'],
+        "image_hash": context.user_data['image_hash'],
         "author": update.effective_user.full_name
     }
 
-    os.makedirs(os.path.dirname(DB_PATH), exist_ok=True)
-    if os.path.exists(DB_PATH):
-        with open(DB_PATH, 'r') as f:
-            data = json.load(f)
-    else:
-        data = []
-    data.append(new_build)
-    with open(DB_PATH, 'w') as f:
-        json.dump(data, f, indent=2)
+    build_id = await build_repo.add(new_build)
 
     # Новая клавиатура с вариантами
     keyboard = [
@@ -580,7 +2656,8 @@ async def confirm_build(update: Update, context: ContextTypes.DEFAULT_TYPE):
     reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
 
     await update.message.reply_text(
-        "✅ Сборка успешно добавлена!\n\nЧто хотите сделать дальше?",
+        f"✅ Сборка успешно добавлена! ID: {build_id}\n"
+        f"🔗 {build_link(context.bot, build_id)}\n\nЧто хотите сделать дальше?",
         reply_markup=reply_markup
     )
 
@@ -594,6 +2671,36 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 )
 
 # === /log ===
+LOG_LEVELS = {"debug": logging.DEBUG, "info": logging.INFO, "warning": logging.WARNING, "error": logging.ERROR}
+
+
+def parse_log_args(args: list) -> dict:
+    """/log [N] [debug|info|warning|error] [@обработчик] [file]"""
+    options = {"limit": 30, "min_level": logging.NOTSET, "handler": None, "from_file": False}
+    for arg in args:
+        if arg.isdigit():
+            options["limit"] = max(1, min(int(arg), 200))
+        elif arg.lower() in LOG_LEVELS:
+            options["min_level"] = LOG_LEVELS[arg.lower()]
+        elif arg.startswith("@") and len(arg) > 1:
+            options["handler"] = arg[1:]
+        elif arg.lower() == "file":
+            options["from_file"] = True
+        else:
+            raise ValueError(arg)
+    return options
+
+
+def fit_message(lines: list, limit: int = 3800) -> str:
+    # Telegram режет сообщения длиннее 4096 символов — оставляем последние строки
+    text = ""
+    for line in reversed(lines):
+        if len(text) + len(line) + 1 > limit:
+            break
+        text = line + "\n" + text
+    return text.rstrip("\n")
+
+
 async def get_logs(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     if user.id not in ALLOWED_USERS:
@@ -601,19 +2708,33 @@ async def get_logs(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     try:
-        result = subprocess.run(
-            ["journalctl", "-u", "ndsborki.service", "-n", "30", "--no-pager"],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            text=True
+        options = parse_log_args(context.args or [])
+    except ValueError as e:
+        await update.message.reply_text(
+            f"⚠️ Непонятный аргумент: {e}\n"
+            "Использование: /log [N] [debug|info|warning|error] [@обработчик] [file]"
         )
-        logs = result.stdout.strip() or result.stderr.strip()
-        if not logs:
-            logs = "⚠️ Логи пусты или недоступны."
+        return
+
+    try:
+        limit = options["limit"]
+        if options["from_file"]:
+            # Файлы — для истории до перезапуска; ошибки пишутся в error.log
+            path = "logs/error.log" if options["min_level"] >= logging.WARNING else "logs/info.log"
+            lines = await run_io(tail_log, path, limit)
+            source = path
+        else:
+            records = log_buffer.tail(limit, options["min_level"], options["handler"])
+            lines = [
+                f"{datetime.fromtimestamp(created):%H:%M:%S} {logging.getLevelName(level)[0]} [{handler}] {message}"
+                for created, level, handler, message in records
+            ]
+            source = "память"
+        logs = html.escape(fit_message(lines)) or "⚠️ Логи пусты или недоступны."
 
         await context.bot.send_message(
             chat_id=ADMIN_ID,
-            text=f"📄 <b>Последние 30 строк лога:</b>\n<pre>{logs}</pre>",
+            text=f"📄 <b>Лог ({source}), записей: {len(lines)}</b>\n<pre>{logs}</pre>",
             parse_mode="HTML"
         )
 
@@ -623,6 +2744,70 @@ async def get_logs(update: Update, context: ContextTypes.DEFAULT_TYPE):
         logging.exception("Ошибка при получении логов")
 
 
+def describe_log_control() -> str:
+    lines = [f"📝 <b>Уровень по умолчанию:</b> <code>{logging.getLevelName(log_control.default_level)}</code>"]
+    if log_control.handler_levels:
+        lines.append("\n🎛 <b>Обработчики:</b>")
+        lines += [f"• <code>{name}</code> — <code>{logging.getLevelName(level)}</code>"
+                  for name, level in sorted(log_control.handler_levels.items())]
+    if log_control.sample_rates:
+        lines.append("\n🎲 <b>Выборка событий:</b>")
+        lines += [f"• <code>{event}</code> — <code>{rate:g}</code>"
+                  for event, rate in sorted(log_control.sample_rates.items())]
+    return "\n".join(lines)
+
+
+# === /loglevel и /logsample: настройка логирования без перезапуска ===
+@admin_only
+async def loglevel_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    args = context.args or []
+    if not args:
+        await update.message.reply_text(
+            describe_log_control() + "\n\nИспользование: /loglevel &lt;обработчик|*&gt; &lt;debug|info|warning|error|reset&gt;",
+            parse_mode="HTML"
+        )
+        return
+    if len(args) != 2:
+        await update.message.reply_text("⚠️ Использование: /loglevel <обработчик|*> <debug|info|warning|error|reset>")
+        return
+
+    handler, level_name = args
+    if handler != "*" and handler not in handler_names:
+        await update.message.reply_text(f"⚠️ Нет обработчика {handler}. Доступны: {', '.join(sorted(handler_names))}")
+        return
+    try:
+        level = None if level_name.lower() == "reset" else parse_level(level_name)
+    except ValueError as e:
+        await update.message.reply_text(f"⚠️ {e}")
+        return
+
+    log_control.set_handler_level(handler, level)
+    logging.warning(f"📝 Уровень логирования {handler}: {level_name.upper()} (изменил {update.effective_user.id})")
+    await update.message.reply_text(describe_log_control(), parse_mode="HTML")
+
+
+@admin_only
+async def logsample_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    args = context.args or []
+    if len(args) != 2:
+        await update.message.reply_text(
+            describe_log_control() + "\n\nИспользование: /logsample &lt;событие&gt; &lt;доля 0…1|reset&gt;",
+            parse_mode="HTML"
+        )
+        return
+
+    event, value = args
+    try:
+        rate = None if value.lower() == "reset" else parse_rate(value)
+    except ValueError as e:
+        await update.message.reply_text(f"⚠️ {e}")
+        return
+
+    log_control.set_sample_rate(event, rate)
+    logging.warning(f"🎲 Выборка события {event}: {value} (изменил {update.effective_user.id})")
+    await update.message.reply_text(describe_log_control(), parse_mode="HTML")
+
+
 
 
 # === Команда /Статус для админов ===   
@@ -632,29 +2817,29 @@ async def status_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("⛔ У вас нет доступа к этой команде.")
         return
 
-    if not os.path.exists(DB_PATH):
+    if not build_repo.exists():
         await update.message.reply_text("❌ База данных отсутствует.")
         return
 
     try:
-        with open(DB_PATH, "r", encoding="utf-8") as f:
-            data = json.load(f)
+        stats = await build_repo.stats()
+        updated_at = await build_repo.updated_at()
     except Exception as e:
         await update.message.reply_text(f"❌ Ошибка при чтении БД: {e}")
         return
 
     # Статус systemd
     try:
-        result = subprocess.run(["systemctl", "is-active", "ndsborki.service"], capture_output=True, text=True)
-        service_status = result.stdout.strip()
+        _, stdout, _ = await run_command("systemctl", "is-active", "ndsborki.service")
+        service_status = stdout.strip()
     except Exception as e:
         service_status = f"⚠️ Ошибка при проверке systemd: {e}"
 
-    total = len(data)
-    formatted_time = datetime.fromtimestamp(os.path.getmtime(DB_PATH)).strftime("%d.%m.%Y %H:%M")
+    total = stats["total"]
+    formatted_time = datetime.fromtimestamp(updated_at).strftime("%d.%m.%Y %H:%M") if updated_at else "—"
 
-    authors = Counter(b.get("author", "—") for b in data)
-    categories = Counter(b.get("category", "—") for b in data)
+    authors = stats["authors"]
+    categories = stats["categories"]
 
     msg = [
         f"🖥 <b>Состояние сервиса:</b> <code>{service_status}</code>",
@@ -669,8 +2854,60 @@ async def status_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         msg.append("\n📁 <b>Категории сборок:</b>")
         msg += [f"• <b>{cat}</b> — <code>{count}</code>" for cat, count in categories.items()]
 
+    queue = rate_limiter.stats()
+    msg.append(
+        f"\n📤 <b>Очередь отправки:</b> в очереди <code>{queue['queued']}</code>,"
+        f" чатов на паузе <code>{queue['paused_chats']}</code>\n"
+        f"• отправлено <code>{queue['sent']}</code>, повторов после 429 <code>{queue['retries']}</code>,"
+        f" макс. ожидание <code>{queue['max_wait']:.2f} с</code>"
+    )
+
+    cache = render_cache.stats()
+    lookups = cache['hits'] + cache['misses']
+    msg.append(
+        f"\n🎨 <b>Кэш подписей и клавиатур:</b> <code>{cache['size']}</code> из <code>{render_cache.maxsize}</code>,"
+        f" попаданий <code>{cache['hits'] * 100 // lookups if lookups else 0}%</code>"
+    )
+
+    updates = sum(metrics.counter("bot_updates_total").values())
+    errors = sum(metrics.counter("bot_handler_errors_total").values())
+    api_calls = sum(h.count for h in metrics.histograms("bot_api_seconds").values())
+    api_errors = sum(metrics.counter("bot_api_errors_total").values())
+    msg.append(
+        f"\n📈 <b>Метрики:</b> апдейтов <code>{updates}</code>, ошибок в обработчиках <code>{errors}</code>,"
+        f" запросов к API <code>{api_calls}</code>, ошибок API <code>{api_errors}</code>"
+    )
+    slowest = sorted(
+        ((h.sum / h.count, h.quantile(0.95), dict(labels)["handler"])
+         for labels, h in metrics.histograms("bot_handler_seconds").items() if h.count),
+        reverse=True,
+    )[:3]
+    msg += [f"• <b>{name}</b> — в среднем <code>{mean * 1000:.0f} мс</code>, p95 ≤ <code>{p95 * 1000:.0f} мс</code>"
+            for mean, p95, name in slowest]
+
+    sizes = [session_size(data) for data in context.application.user_data.values()]
+    if sizes:
+        msg.append(
+            f"\n🧠 <b>Сессии:</b> <code>{len(sizes)}</code>, в среднем <code>{sum(sizes) // len(sizes)} Б</code>,"
+            f" максимум <code>{max(sizes)} Б</code>"
+        )
+
     await update.message.reply_text("\n".join(msg), parse_mode="HTML")
 
+# Примерный размер пользовательской сессии вместе с вложенными контейнерами
+def session_size(obj, _seen=None) -> int:
+    seen = set() if _seen is None else _seen
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, (dict, MappingProxyType)):
+        size += sum(session_size(k, seen) + session_size(v, seen) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(session_size(v, seen) for v in obj)
+    return size
+
+
 # === Команда /home — возврат в главное меню ===
 async def home_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     context.user_data.clear()  # 🧹 очищаем всю сессию пользователя
@@ -680,40 +2917,88 @@ async def home_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 
 
+# === Постраничные списки /show_all и /delete: ◀/▶ редактируют то же сообщение ===
+def _show_all_entry(b) -> str:
+    return (
+        f"<b>{b['id']}. {b.get('weapon_name', '—').upper()}</b>\n"
+        f"├ Дистанция: {b.get('role', '-')}\n"
+        f"├ Тип: {b.get('type', '-')}\n"
+        f"├ Модулей: {len(b.get('modules', {}))}\n"
+        f"└ Автор: {b.get('author', '-')}"
+    )
+
+
+def _delete_entry(b) -> str:
+    translation = module_catalog.translation(b.get("type", ""))
+    modules = "\n".join(f"🔸 {k}: {translation.get(v, v)}" for k, v in b.get("modules", {}).items())
+    return f"{b['weapon_name']} (ID {b['id']})\nТип: {b['type']}\n\nМодулей: {len(b['modules'])}\n{modules}\n\nАвтор: {b['author']}"
+
+
+# Вид списка → (режим, сборок на странице, заголовок, оформление сборки)
+LIST_VIEWS = {
+    "all": ("warzone", SHOW_ALL_PAGE_SIZE, "📄 <b>Сборки Warzone:</b>", _show_all_entry),
+    "del": (None, DELETE_PAGE_SIZE, "🧾 Сборки для удаления:", _delete_entry),
+}
+
+
+async def render_list_page(kind: str, after: int = None, before: int = None):
+    """Текст и кнопки одной страницы списка; (None, None), если список пуст."""
+    mode, limit, title, entry = LIST_VIEWS[kind]
+    builds, has_prev, has_next = await build_repo.page(mode, after=after, before=before, limit=limit)
+    if not builds and (after is not None or before is not None):
+        # Страница опустела (сборки удалили) — возвращаемся в начало
+        builds, has_prev, has_next = await build_repo.page(mode, limit=limit)
+    if not builds:
+        return None, None
+
+    text = "\n\n".join([title, *(entry(b) for b in builds)])
+    nav = []
+    if has_prev:
+        nav.append(InlineKeyboardButton("◀", callback_data=f"page:{kind}:b:{builds[0]['id']}"))
+    if has_next:
+        nav.append(InlineKeyboardButton("▶", callback_data=f"page:{kind}:a:{builds[-1]['id']}"))
+    rows = [nav] if nav else []
+    if kind == "del":
+        text += f"\n\nВведите ID сборки для удаления (например: {builds[0]['id']})"
+        rows.append([InlineKeyboardButton("🚪 Выйти из удаления", callback_data="stop_delete")])
+    return text, InlineKeyboardMarkup(rows)
+
+
+async def list_page_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    _, kind, direction, cursor = query.data.split(":")
+    if kind == "del" and update.effective_user.id not in ALLOWED_USERS:
+        await query.answer("⛔ У вас нет доступа.")
+        return
+    await query.answer()
+
+    cursor = int(cursor)
+    text, markup = await render_list_page(kind, **({"after": cursor} if direction == "a" else {"before": cursor}))
+    if text is None:
+        await query.edit_message_text("Список сборок пуст.")
+        return
+    try:
+        await query.edit_message_text(text, reply_markup=markup, parse_mode="HTML")
+    except BadRequest as e:
+        # Повторное нажатие на ту же страницу
+        if "not modified" not in str(e).lower():
+            raise
+
+
 # === Команда /show_all — список всех сборок текстом ===
 async def show_all_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not os.path.exists(DB_PATH):
+    if not build_repo.exists():
         await update.message.reply_text("Список сборок пуст.")
         return
 
-    with open(DB_PATH, 'r') as f:
-        data = json.load(f)
-
     # ✅ Показываем только Warzone
-    data = [b for b in data if b.get("mode", "").lower() == "warzone"]
+    text, markup = await render_list_page("all")
 
-    if not data:
+    if text is None:
         await update.message.reply_text("Список сборок пуст.")
         return
 
-    lines = ["📄 <b>Сборки Warzone:</b>"]
-    for idx, b in enumerate(data, start=1):
-        translation = load_translation_dict(b.get("type", ""))  # ✅ загрузка перевода
-        modules_text = "\n".join(
-            f"🔸 {k}: {translation.get(v, v)}" for k, v in b.get("modules", {}).items()
-        )
-
-        lines.append(
-            f"<b>{idx}. {b.get('weapon_name', '—').upper()}</b>\n"
-            f"├ Дистанция: {b.get('role', '-')}\n"
-            f"├ Тип: {b.get('type', '-')}\n"
-            f"├ Модулей: {len(b.get('modules', {}))}\n"
-            f"└ Автор: {b.get('author', '-')}"
-        )
-
-    result = "\n\n".join(lines)
-    markup = ReplyKeyboardMarkup([['🏠 Главное меню']], resize_keyboard=True)
-    await update.message.reply_text(result, reply_markup=markup, parse_mode="HTML")
+    await update.message.reply_text(text, reply_markup=markup, parse_mode="HTML")
 
 
 # Отмена действия и сброс клавиатуры
@@ -721,6 +3006,33 @@ async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("❌ Действие отменено.", reply_markup=ReplyKeyboardRemove())
     return ConversationHandler.END
 
+# === /reload ===
+@admin_only
+async def reload_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    try:
+        report = await reload_data()
+    except ValueError as e:
+        logging.warning(f"❌ /reload отменён: {e}")
+        await update.message.reply_text(f"❌ Перезагрузка отменена, остаются прежние данные:\n{e}")
+        return
+
+    logging.info(f"🔄 /reload: {report['builds']} сборок, {report['types']} типов, "
+                 f"{len(report['modules'])} каталогов модулей за {report['total_ms']:.1f} мс "
+                 f"(чтение {report['load_ms']:.1f} мс, подмена {report['swap_ms']:.3f} мс)")
+    text = (
+        f"🔄 Данные перезагружены за {report['total_ms']:.1f} мс\n"
+        f"⏱ Чтение и индексы: {report['load_ms']:.1f} мс, подмена: {report['swap_ms']:.3f} мс\n\n"
+        f"📦 Сборок: {report['builds']}"
+        + (" (SQLite, не перечитывается)" if not isinstance(build_repo, BuildStore) else "") + "\n"
+        f"🏷 Типов оружия: {report['types']}\n"
+        f"🧩 Каталоги модулей: {', '.join(report['modules']) or '—'}"
+    )
+    if report['unknown_types']:
+        text += f"\n⚠️ Типы сборок, которых нет в types.json: {', '.join(report['unknown_types'])}"
+    await update.message.reply_text(text)
+    await save_index_snapshot()
+
+
 # === /restart ===
 @admin_only
 async def restart_bot(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -732,88 +3044,1046 @@ async def restart_bot(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
 
     # Для уведомления в лог-канал
-    with open("restarted_by.txt", "w") as f:
-        f.write(f"{user.full_name} (ID: {user.id})")
+    await write_text("restarted_by.txt", f"{user.full_name} (ID: {user.id})")
 
     # Для личного уведомления после перезапуска
-    with open("restart_message.txt", "w") as f:
-        f.write(str(user.id))
-
-    os._exit(0)
-
-
-
-
-
-
-
-    # 💣 Завершаем процесс — systemd сам перезапустит
-    os._exit(0)
+    await write_text("restart_message.txt", str(user.id))
 
+    # Штатная остановка: сессии и состояния диалогов успевают сохраниться,
+    # после выхода процесса systemd сам его перезапустит
+    request_shutdown(context.application)
 
 
 # Выбор категории в пользов части
 async def view_category_select(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not os.path.exists(DB_PATH):
+    if not build_repo.exists():
         await update.message.reply_text("⚠️ База данных не найдена.")
         return ConversationHandler.END
 
-    with open(DB_PATH, 'r', encoding='utf-8') as f:
-        data = json.load(f)
-
     raw_categories = {
         "Топовая мета": "🔥 Топовая мета",
         "Мета": "📈 Мета",
         "Новинки": "🆕 Новинки"
     }
 
-    counts = {
-        cat: sum(1 for b in data if b.get("mode", "").lower() == "warzone" and b.get("category") == cat)
-        for cat in raw_categories
-    }
-
     user_input = update.message.text.strip().split(" (")[0]
 
     for key, label in raw_categories.items():
         if user_input == label:
             context.user_data['selected_category'] = key
 
-            weapon_types = load_weapon_types()
-            key_to_label = {item["key"]: item["label"] for item in weapon_types}
+            async def type_markup():
+                type_keys = await build_repo.keys("warzone", key)
+                return ReplyKeyboardMarkup([[weapon_types.label(t)] for t in type_keys], resize_keyboard=True)
 
-            type_keys = sorted(set(
-                b['type'] for b in data
-                if b.get("mode", "").lower() == "warzone" and b.get("category") == key
-            ))
-
-            buttons = [[key_to_label.get(t, t)] for t in type_keys]
-            context.user_data['label_to_key'] = {v: k for k, v in key_to_label.items()}
-            return await update.message.reply_text("Выберите тип оружия:", reply_markup=ReplyKeyboardMarkup(buttons, resize_keyboard=True))
+            markup = await render_cache.get(("types", key), type_markup)
+            await update.message.reply_text("Выберите тип оружия:", reply_markup=markup)
+            return VIEW_WEAPON
 
     # Если просто нажали «📋 Сборки Warzone» — показать список категорий
-    buttons = [[f"{label} ({counts[key]})"] for key, label in raw_categories.items()]
-    await update.message.reply_text("Выберите категорию:", reply_markup=ReplyKeyboardMarkup(buttons, resize_keyboard=True))
+    async def category_markup():
+        buttons = [[f"{label} ({await build_repo.count('warzone', key)})"] for key, label in raw_categories.items()]
+        return ReplyKeyboardMarkup(buttons, resize_keyboard=True)
+
+    markup = await render_cache.get(("categories",), category_markup)
+    await update.message.reply_text("Выберите категорию:", reply_markup=markup)
     return VIEW_CATEGORY_SELECT
 
 
 
+# === Параллельная обработка апдейтов с сохранением порядка для каждого пользователя ===
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """Апдейты разных пользователей обрабатываются параллельно, одного — строго по очереди.
+
+    Очерёдность нужна ConversationHandler'ам (add_conv/view_conv) и context.user_data.
+    Ожидающие своей очереди апдейты не занимают слоты обработки: базовый семафор
+    ограничивает только число апдейтов в работе вообще (MAX_PENDING_UPDATES),
+    а параллелизм обработчиков — собственный семафор (UPDATE_CONCURRENCY).
+    """
+
+    def __init__(self, max_concurrent_handlers: int, max_pending_updates: int):
+        super().__init__(max_pending_updates)
+        self._handler_slots = asyncio.Semaphore(max_concurrent_handlers)
+        self._user_locks: dict[int, asyncio.Lock] = {}
+        self._user_pending = Counter()
+
+    @staticmethod
+    def _ordering_key(update: object):
+        if isinstance(update, Update):
+            if update.effective_user:
+                return update.effective_user.id
+            if update.effective_chat:
+                return update.effective_chat.id
+        return None
+
+    async def do_process_update(self, update: object, coroutine) -> None:
+        key = self._ordering_key(update)
+        if key is None:
+            async with self._handler_slots:
+                await coroutine
+            return
+
+        lock = self._user_locks.setdefault(key, asyncio.Lock())
+        self._user_pending[key] += 1
+        try:
+            async with lock, self._handler_slots:
+                await coroutine
+        finally:
+            self._user_pending[key] -= 1
+            if not self._user_pending[key]:
+                del self._user_pending[key]
+                del self._user_locks[key]
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+
+# === Метрики: гистограммы и счётчики в формате Prometheus ===
+class Histogram:
+    """Гистограмма длительностей с фиксированными границами (секунды)."""
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+    __slots__ = ('counts', 'sum', 'count')
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q: float) -> float:
+        # Верхняя граница корзины, в которую попал квантиль (inf — дольше 10 с)
+        rank = q * self.count
+        seen = 0
+        for bound, n in zip(self.BUCKETS + (float("inf"),), self.counts):
+            seen += n
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+
+def _label_text(labels: tuple) -> str:
+    if not labels:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in labels)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(labels, escaped)) + "}"
+
+
+class Metrics:
+    """Метрики процесса: длительности обработчиков и запросов к Bot API, счётчики.
+
+    Пишутся из цикла событий без блокировок. Значения, которые уже считают
+    другие объекты (кэши, очередь отправки), снимаются в момент запроса
+    функциями-сборщиками.
+    """
+
+    def __init__(self):
+        self._meta: dict = {}  # имя → (тип, описание)
+        self._histograms: dict = {}  # имя → {метки → Histogram}
+        self._counters: dict = {}  # имя → Counter(метки → значение)
+        self._collectors: list = []
+
+    def describe(self, name: str, kind: str, help_text: str):
+        self._meta[name] = (kind, help_text)
+        (self._histograms if kind == "histogram" else self._counters).setdefault(
+            name, {} if kind == "histogram" else Counter())
+
+    def observe(self, name: str, value: float, **labels):
+        series = self._histograms[name]
+        key = tuple(sorted(labels.items()))
+        histogram = series.get(key)
+        if histogram is None:
+            histogram = series[key] = Histogram()
+        histogram.observe(value)
+
+    def inc(self, name: str, amount: float = 1, **labels):
+        self._counters[name][tuple(sorted(labels.items()))] += amount
+
+    def histograms(self, name: str) -> dict:
+        return self._histograms[name]
+
+    def counter(self, name: str) -> Counter:
+        return self._counters[name]
+
+    def collector(self, func):
+        """Регистрирует func() → [(имя, тип, описание, метки, значение)], вызываемую при выдаче."""
+        self._collectors.append(func)
+        return func
+
+    def render(self) -> str:
+        lines = []
+        for name, (kind, help_text) in self._meta.items():
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+            if kind == "histogram":
+                for labels, h in self._histograms[name].items():
+                    cumulative = 0
+                    for bound, n in zip(Histogram.BUCKETS + ("+Inf",), h.counts):
+                        cumulative += n
+                        lines.append(f"{name}_bucket{_label_text(labels + (('le', bound),))} {cumulative}")
+                    lines.append(f"{name}_sum{_label_text(labels)} {h.sum}")
+                    lines.append(f"{name}_count{_label_text(labels)} {h.count}")
+            else:
+                lines += [f"{name}{_label_text(labels)} {value}" for labels, value in self._counters[name].items()]
+        described = set()
+        for collect in self._collectors:
+            try:
+                samples = list(collect())
+            except Exception:
+                logging.exception(f"❌ Сборщик метрик {collect.__name__} упал")
+                continue
+            for name, kind, help_text, labels, value in samples:
+                if name not in described:
+                    described.add(name)
+                    lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+                lines.append(f"{name}{_label_text(tuple(sorted(labels.items())))} {value}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+metrics.describe("bot_updates_total", "counter", "Входящие апдейты")
+metrics.describe("bot_handler_seconds", "histogram", "Время работы обработчика")
+metrics.describe("bot_handler_errors_total", "counter", "Исключения в обработчиках")
+metrics.describe("bot_api_seconds", "histogram", "Длительность запросов к Bot API (без ожидания в очереди)")
+metrics.describe("bot_api_errors_total", "counter", "Ошибки запросов к Bot API")
+metrics.describe("bot_photo_file_id_total", "counter", "Отправка картинок: по file_id (hit) или загрузкой файла (miss)")
+
+
+@metrics.collector
+def collect_runtime_metrics():
+    cache = render_cache.stats()
+    yield "bot_render_cache_total", "counter", "Обращения к кэшу подписей и клавиатур", {"result": "hit"}, cache["hits"]
+    yield "bot_render_cache_total", "counter", "Обращения к кэшу подписей и клавиатур", {"result": "miss"}, cache["misses"]
+    yield "bot_render_cache_entries", "gauge", "Записей в кэше подписей и клавиатур", {}, cache["size"]
+    queue = rate_limiter.stats()
+    yield "bot_send_queue", "gauge", "Отправки в очереди", {}, queue["queued"]
+    yield "bot_send_retries_total", "counter", "Повторы после 429", {}, queue["retries"]
+    yield "bot_builds", "gauge", "Сборок в хранилище", {}, len(build_repo.snapshot()) if isinstance(build_repo, BuildStore) else float("nan")
+    yield "bot_sessions", "gauge", "Пользовательских сессий в памяти", {}, len(app.user_data)
+    yield "bot_uptime_seconds", "gauge", "Время с запуска процесса", {}, round(time.monotonic() - PROCESS_STARTED, 3)
+
+
+handler_names = set()  # имена обёрнутых обработчиков — для проверки /loglevel
+
+
+def timed_callback(scope: str, callback):
+    """Оборачивает callback обработчика: длительность и исключения попадают в метрики,
+    а записи лога внутри него помечаются именем обработчика."""
+    name = getattr(callback, "__name__", type(callback).__name__)
+    handler_names.add(name)
+
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        started = time.perf_counter()
+        token = current_handler.set(name)
+        try:
+            return await callback(update, context)
+        except Exception as e:
+            metrics.inc("bot_handler_errors_total", conversation=scope, handler=name, error=type(e).__name__)
+            raise
+        finally:
+            current_handler.reset(token)
+            metrics.observe("bot_handler_seconds", time.perf_counter() - started, conversation=scope, handler=name)
+    return wrapper
+
+
+def instrument_handler(handler, scope: str = "global"):
+    # Рекурсивно: диалоги — по entry_points/states/fallbacks, ButtonRouter — по кнопкам
+    if isinstance(handler, ConversationHandler):
+        nested = list(handler.entry_points) + list(handler.fallbacks)
+        nested += [h for handlers in handler.states.values() for h in handlers]
+        for h in nested:
+            instrument_handler(h, handler.name or "conversation")
+    elif isinstance(handler, ButtonRouter):
+        for label, callback in handler.routes.items():
+            handler.routes[label] = timed_callback(scope, callback)
+        for h in handler.fallback:
+            instrument_handler(h, scope)
+    else:
+        handler.callback = timed_callback(scope, handler.callback)
+
+
+async def count_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    metrics.inc("bot_updates_total", kind="callback" if update.callback_query else "message")
+
+
+class MetricsServer:
+    """GET /metrics в текстовом формате Prometheus; соединение закрывается после ответа."""
+
+    def __init__(self, listen: str, port: int):
+        self.listen = listen
+        self.port = port
+        self._server = None
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, self.listen, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        logging.info(f"📈 Метрики: http://{self.listen}:{self.port}/metrics")
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+
+    async def _handle(self, reader, writer):
+        try:
+            request_line = await reader.readline()
+            while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                pass
+            parts = request_line.decode("latin-1").split(" ")
+            if len(parts) < 2 or parts[0] != "GET" or parts[1].split("?", 1)[0] != "/metrics":
+                status, body = 404, b""
+            else:
+                status, body = 200, metrics.render().encode("utf-8")
+            writer.write(
+                f"HTTP/1.1 {status} {HTTPStatus(status).phrase}\r\n"
+                f"Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body
+            )
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+
+metrics_server = MetricsServer(METRICS_LISTEN, METRICS_PORT) if METRICS_PORT else None
+
+
+# === Ограничение исходящих запросов (flood control Telegram) ===
+# Методы, которые создают новые сообщения в чате: только на них Telegram
+# считает лимиты 1/с на чат и 30/с на бота. Правки, ответы на нажатия и
+# удаления идут без очереди.
+PACED_METHODS = frozenset({
+    "sendMessage", "sendPhoto", "sendDocument", "sendVideo", "sendAnimation",
+    "sendAudio", "sendVoice", "sendSticker", "sendMediaGroup", "copyMessage",
+    "copyMessages", "forwardMessage", "forwardMessages",
+})
+
+
+class TokenBucket:
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def wait_time(self, now: float) -> float:
+        # Сколько ждать до следующего токена (0 — можно сразу)
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+
+def _retry_after_seconds(error: RetryAfter) -> float:
+    value = error.retry_after
+    return value.total_seconds() if isinstance(value, timedelta) else float(value)
+
+
+class FloodControlRateLimiter(BaseRateLimiter):
+    """Планировщик отправок новых сообщений в чат (PACED_METHODS).
+
+    Токен-бакеты на бота целиком и на каждый чат; запас chat_burst покрывает
+    пачку сообщений одного ответа. Ожидающие отправки выпускает по очереди одна
+    задача-диспетчер. На RetryAfter чат ставится на паузу, запрос повторяется с
+    нарастающей задержкой не более max_retries раз. Остальные методы (правки,
+    answerCallbackQuery, getMe) и все запросы при enabled=False идут сразу.
+    """
+
+    CHAT_BUCKETS_LIMIT = 10000
+
+    def __init__(self, global_rate: float, chat_rate: float, chat_burst: int, max_retries: int,
+                 enabled: bool = True):
+        self.enabled = enabled
+        self._global = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self._chats: dict = {}
+        self._paused: dict = {}  # chat_id → time.monotonic(), до которого чат на паузе
+        self._waiting: list = []  # (порядковый номер, chat_id, future)
+        self._seq = itertools.count()
+        self._wake = None
+        self._dispatcher = None
+        self.sent = 0
+        self.retries = 0
+        self.max_wait = 0.0
+
+    async def initialize(self) -> None:
+        # PTB вызывает initialize дважды (Application и Updater) — второй диспетчер не нужен
+        if self._dispatcher is not None and not self._dispatcher.done():
+            return
+        self._wake = asyncio.Event()
+        self._dispatcher = asyncio.get_running_loop().create_task(self._dispatch())
+
+    async def shutdown(self) -> None:
+        if self._dispatcher is not None:
+            self._dispatcher.cancel()
+            await asyncio.gather(self._dispatcher, return_exceptions=True)
+            self._dispatcher = None
+        for *_, future in self._waiting:
+            future.cancel()
+        self._waiting.clear()
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        return {
+            "queued": len(self._waiting),
+            "paused_chats": sum(1 for until in self._paused.values() if until > now),
+            "sent": self.sent,
+            "retries": self.retries,
+            "max_wait": self.max_wait,
+        }
+
+    def _chat_bucket(self, chat_id, now: float) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) >= self.CHAT_BUCKETS_LIMIT:
+                # Полные бакеты ничего не ограничивают — их можно забыть
+                self._chats = {cid: b for cid, b in self._chats.items()
+                               if b.wait_time(now) or b.tokens < b.capacity}
+            bucket = self._chats[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    def _release_next(self, now: float):
+        # Выпускает самый ранний запрос, которому можно идти; иначе — сколько ждать
+        wait = None
+        for entry in self._waiting:
+            _, chat_id, future = entry
+            if future.done():
+                # Ожидавший обработчик отменён
+                self._waiting.remove(entry)
+                return 0.0
+            paused = self._paused.get(chat_id, 0) - now
+            if paused <= 0:
+                self._paused.pop(chat_id, None)
+            bucket = self._chat_bucket(chat_id, now)
+            delay = max(paused, bucket.wait_time(now))
+            if delay <= 0:
+                bucket.tokens -= 1
+                self._global.tokens -= 1
+                self._waiting.remove(entry)
+                future.set_result(None)
+                return 0.0
+            wait = delay if wait is None else min(wait, delay)
+        return wait
+
+    async def _dispatch(self):
+        while True:
+            timeout = None
+            if self._waiting:
+                now = time.monotonic()
+                timeout = self._global.wait_time(now) or self._release_next(now)
+                if timeout == 0:
+                    continue
+            self._wake.clear()
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _acquire(self, chat_id):
+        future = asyncio.get_running_loop().create_future()
+        self._waiting.append((next(self._seq), chat_id, future))
+        self._wake.set()
+        await future
+
+    @staticmethod
+    async def _call(callback, args, kwargs, endpoint):
+        # Время самого запроса, без ожидания в очереди
+        started = time.perf_counter()
+        try:
+            return await callback(*args, **kwargs)
+        except Exception as e:
+            metrics.inc("bot_api_errors_total", method=endpoint, error=type(e).__name__)
+            raise
+        finally:
+            metrics.observe("bot_api_seconds", time.perf_counter() - started, method=endpoint)
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        chat_id = data.get("chat_id")
+        if chat_id is None or endpoint not in PACED_METHODS or not self.enabled:
+            return await self._call(callback, args, kwargs, endpoint)
+
+        for attempt in range(self.max_retries + 1):
+            queued_at = time.monotonic()
+            await self._acquire(chat_id)
+            self.max_wait = max(self.max_wait, time.monotonic() - queued_at)
+            try:
+                result = await self._call(callback, args, kwargs, endpoint)
+            except RetryAfter as e:
+                if attempt == self.max_retries:
+                    raise
+                self.retries += 1
+                delay = _retry_after_seconds(e) + 0.5 * 2 ** attempt
+                self._paused[chat_id] = max(self._paused.get(chat_id, 0), time.monotonic() + delay)
+                logging.warning(f"⏳ Flood control в чате {chat_id} ({endpoint}): повтор через {delay:.1f} с")
+                continue
+            self.sent += 1
+            return result
+
+
+# === Сессии (user_data и состояния диалогов) между перезапусками ===
+class SqlitePersistence(BasePersistence):
+    """user_data и состояния ConversationHandler в SQLite.
+
+    PTB сам отмечает затронутых пользователей и раз в update_interval передаёт
+    их данные сюда. Здесь данные сериализуются в JSON, неизменившиеся
+    отбрасываются по хэшу, а остальное за цикл пишется одной транзакцией в
+    отдельном потоке. chat_data, bot_data и callback_data боту не нужны и не
+    хранятся.
+    """
+
+    def __init__(self, path: str, update_interval: float):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval,
+        )
+        self.path = path
+        self._conn = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="persistence")
+        self._stored: dict = {}  # user_id → hash последнего записанного JSON
+        self._pending_users: dict = {}  # user_id → JSON или None (удалить)
+        self._pending_conversations: dict = {}  # (имя, ключ) → JSON состояния или None
+        self._commit_task = None
+
+    async def _run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(func, *args))
+
+    def _connect(self):
+        if self._conn is not None:
+            return self._conn
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        conn = sqlite3.connect(self.path, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS user_data (user_id INTEGER PRIMARY KEY, data TEXT NOT NULL);
+            CREATE TABLE IF NOT EXISTS conversations (
+                name TEXT NOT NULL, key TEXT NOT NULL, state TEXT NOT NULL, PRIMARY KEY (name, key)
+            );
+        """)
+        self._conn = conn
+        return conn
+
+    def _load_users(self) -> dict:
+        rows = self._connect().execute("SELECT user_id, data FROM user_data").fetchall()
+        return {user_id: data for user_id, data in rows}
+
+    def _load_conversations(self, name: str) -> dict:
+        rows = self._connect().execute("SELECT key, state FROM conversations WHERE name = ?", (name,))
+        return {tuple(json.loads(key)): json.loads(state) for key, state in rows}
+
+    def _write(self, users: dict, conversations: dict):
+        conn = self._connect()
+        with conn:
+            conn.executemany("INSERT OR REPLACE INTO user_data (user_id, data) VALUES (?, ?)",
+                             [(uid, data) for uid, data in users.items() if data is not None])
+            conn.executemany("DELETE FROM user_data WHERE user_id = ?",
+                             [(uid,) for uid, data in users.items() if data is None])
+            conn.executemany("INSERT OR REPLACE INTO conversations (name, key, state) VALUES (?, ?, ?)",
+                             [(name, key, state) for (name, key), state in conversations.items() if state is not None])
+            conn.executemany("DELETE FROM conversations WHERE name = ? AND key = ?",
+                             [(name, key) for (name, key), state in conversations.items() if state is None])
+
+    async def _commit(self):
+        # Дожидаемся, пока PTB передаст все изменения текущего цикла
+        await asyncio.sleep(0)
+        self._commit_task = None
+        users, self._pending_users = self._pending_users, {}
+        conversations, self._pending_conversations = self._pending_conversations, {}
+        if not users and not conversations:
+            return
+        try:
+            await self._run(self._write, users, conversations)
+        except Exception:
+            logging.exception("❌ Не удалось сохранить сессии, повторим в следующем цикле")
+            # Более свежие изменения, пришедшие за время записи, важнее
+            self._pending_users = {**users, **self._pending_users}
+            self._pending_conversations = {**conversations, **self._pending_conversations}
+
+    def _schedule_commit(self):
+        if self._commit_task is None:
+            self._commit_task = asyncio.get_running_loop().create_task(self._commit())
+
+    # --- Чтение при старте ---
+    async def get_user_data(self) -> dict:
+        rows = await self._run(self._load_users)
+        self._stored = {uid: hash(data) for uid, data in rows.items()}
+        logging.info(f"💾 Загружены сессии пользователей: {len(rows)}")
+        return {uid: json.loads(data) for uid, data in rows.items()}
+
+    async def get_conversations(self, name: str) -> dict:
+        return await self._run(self._load_conversations, name)
+
+    async def get_chat_data(self) -> dict:
+        return {}
+
+    async def get_bot_data(self) -> dict:
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    # --- Изменения копятся и пишутся пачкой ---
+    async def update_user_data(self, user_id: int, data: dict) -> None:
+        try:
+            text = json.dumps(data, ensure_ascii=False, separators=(",", ":"))
+        except (TypeError, ValueError):
+            logging.exception(f"❌ Сессию пользователя {user_id} не удалось сохранить")
+            return
+        digest = hash(text)
+        if self._stored.get(user_id) == digest:
+            return
+        self._stored[user_id] = digest
+        self._pending_users[user_id] = text
+        self._schedule_commit()
+
+    async def drop_user_data(self, user_id: int) -> None:
+        self._stored.pop(user_id, None)
+        self._pending_users[user_id] = None
+        self._schedule_commit()
+
+    async def update_conversation(self, name: str, key, new_state) -> None:
+        state = None if new_state is None else json.dumps(new_state)
+        self._pending_conversations[(name, json.dumps(list(key)))] = state
+        self._schedule_commit()
+
+    async def update_chat_data(self, chat_id: int, data: dict) -> None:
+        pass
+
+    async def update_bot_data(self, data: dict) -> None:
+        pass
+
+    async def update_callback_data(self, data) -> None:
+        pass
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        pass
+
+    async def refresh_user_data(self, user_id: int, user_data: dict) -> None:
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict) -> None:
+        pass
+
+    async def refresh_bot_data(self, bot_data: dict) -> None:
+        pass
+
+    async def flush(self) -> None:
+        if self._commit_task is not None:
+            await self._commit_task
+        await self._commit()
+        if self._conn is not None:
+            await self._run(self._conn.close)
+            self._conn = None
+
+
+# === Bot API без сети ===
+class OfflineRequest(BaseRequest):
+    """Заглушка Bot API: отвечает правдоподобными объектами и считает вызовы.
+
+    Нужна, чтобы гонять весь стек обработчиков без доступа к Telegram.
+    """
+
+    # Скачиваемый «файл» — настоящая картинка 1×1 PNG, иначе ImageStore её не примет
+    FILE_CONTENT = (b"\x89PNG\r\n\x1a\n\x00\x00\x00\rIHDR\x00\x00\x00\x01\x00\x00\x00\x01\x08\x00\x00\x00\x00:~\x9bU"
+                    b"\x00\x00\x00\nIDATx\x9cc`\x00\x00\x00\x02\x00\x01H\xaf\xa4q\x00\x00\x00\x00IEND\xaeB`\x82")
+
+    def __init__(self):
+        self.calls = Counter()
+        self._message_ids = itertools.count(1)
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None,
+                         write_timeout=None, connect_timeout=None, pool_timeout=None):
+        if "/file/bot" in url:
+            return 200, self.FILE_CONTENT
+        name = url.rsplit("/", 1)[-1]
+        self.calls[name] += 1
+        params = request_data.parameters if request_data else {}
+        if name == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "offline", "username": "offline_bot"}
+        elif name.startswith(("send", "edit")):
+            message_id = next(self._message_ids)
+            result = {"message_id": message_id, "date": int(time.time()),
+                      "chat": {"id": params.get("chat_id", 0), "type": "private"}}
+            if name in ("sendPhoto", "editMessageMedia"):
+                result["photo"] = [{"file_id": f"offline-{message_id}", "file_unique_id": f"offline-{message_id}",
+                                    "width": 1, "height": 1}]
+        elif name == "getFile":
+            result = {"file_id": params.get("file_id", ""), "file_unique_id": "offline", "file_path": "offline/file"}
+        else:
+            result = True
+        return 200, json.dumps({"ok": True, "result": result}).encode()
+
+
+# === Вебхук: свой HTTP-сервер на asyncio ===
+class WebhookServer:
+    """Минимальный HTTP/1.1-сервер для вебхука Telegram.
+
+    Принимает только POST на path с верным X-Telegram-Bot-Api-Secret-Token,
+    кладёт апдейт в очередь приложения и сразу отвечает 200 — дальше работает
+    обычный конвейер PTB. Соединения keep-alive, как их держит Telegram.
+    """
+
+    def __init__(self, application, listen: str, port: int, path: str, secret: str):
+        if not secret:
+            # Без секрета любой, кто узнал адрес, может прислать апдейт от имени админа
+            raise ValueError("вебхук без секретного токена не запускается")
+        self.application = application
+        self.listen = listen
+        self.port = port
+        self.path = path
+        self.secret = secret.encode()
+        self._server = None
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, self.listen, self.port)
+        # port=0 — свободный порт от системы
+        self.port = self._server.sockets[0].getsockname()[1]
+        logging.info(f"🌐 Вебхук слушает http://{self.listen}:{self.port}{self.path}")
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+
+    async def _dispatch(self, method: str, target: str, headers: dict, body: bytes) -> int:
+        if target.split("?", 1)[0] != self.path:
+            return 404
+        if method != "POST":
+            return 405
+        token = headers.get("x-telegram-bot-api-secret-token", "").encode()
+        if not hmac.compare_digest(token, self.secret):
+            return 403
+        try:
+            update = Update.de_json(json.loads(body), self.application.bot)
+        except Exception as e:
+            logging.warning(f"⚠️ Вебхук: некорректный апдейт ({e})")
+            return 400
+        await self.application.update_queue.put(update)
+        return 200
+
+    @staticmethod
+    async def _respond(writer, status: int, close: bool):
+        writer.write(
+            f"HTTP/1.1 {status} {HTTPStatus(status).phrase}\r\nContent-Length: 0\r\n"
+            f"Connection: {'close' if close else 'keep-alive'}\r\n\r\n".encode()
+        )
+        await writer.drain()
+
+    async def _handle(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                try:
+                    method, target, _ = request_line.decode("latin-1").split(" ", 2)
+                    length = int(headers.get("content-length") or 0)
+                except ValueError:
+                    await self._respond(writer, 400, close=True)
+                    break
+                if length > WEBHOOK_MAX_BODY:
+                    await self._respond(writer, 413, close=True)
+                    break
+                body = await reader.readexactly(length) if length else b""
+                status = await self._dispatch(method, target, headers, body)
+                close = headers.get("connection", "").lower() == "close"
+                await self._respond(writer, status, close)
+                if close:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+
+# Событие остановки serve_webhook; при run_polling — None
+webhook_stop = None
+
+
+def request_shutdown(application):
+    if webhook_stop is not None:
+        webhook_stop.set()
+    else:
+        application.stop_running()
+
+
+def webhook_secret() -> str:
+    """WEBHOOK_SECRET или случайный токен на время работы процесса.
+
+    Случайный годится, только если бот сам вызывает setWebhook (задан WEBHOOK_URL);
+    иначе Telegram не узнает токен, и запуск отменяется.
+    """
+    if WEBHOOK_SECRET:
+        return WEBHOOK_SECRET
+    if not WEBHOOK_URL:
+        raise SystemExit("❌ Для BOT_MODE=webhook нужен WEBHOOK_SECRET (или WEBHOOK_URL, тогда токен создаётся сам)")
+    logging.info("🔐 WEBHOOK_SECRET не задан — для setWebhook создан случайный токен")
+    return secrets.token_urlsafe(32)
+
+
+async def serve_webhook(application):
+    """Работа в режиме вебхука вместо run_polling."""
+    global webhook_stop
+    secret = webhook_secret()
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    server = WebhookServer(application, WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_PATH, secret)
+    await server.start()
+    await application.start()
+    if WEBHOOK_URL:
+        await application.bot.set_webhook(WEBHOOK_URL, secret_token=secret, allowed_updates=Update.ALL_TYPES)
+        logging.info(f"🔗 Вебхук зарегистрирован: {WEBHOOK_URL}")
+    else:
+        logging.warning("⚠️ WEBHOOK_URL не задан — setWebhook не вызывается")
+
+    webhook_stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, webhook_stop.set)
+    try:
+        await webhook_stop.wait()
+    finally:
+        await server.stop()
+        await application.stop()
+        if application.post_stop:
+            await application.post_stop(application)
+        await application.shutdown()
+
+
+# === Прогон записанных апдейтов через локальный вебхук: python bot2.py --replay updates.jsonl ===
+async def replay_updates(application, path: str):
+    data = await read_file(path)
+    if data is None:
+        raise SystemExit(f"❌ Файл {path} не найден")
+    updates = [line.encode('utf-8') for line in data.decode('utf-8').splitlines() if line.strip()]
+
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    await application.start()
+    secret = WEBHOOK_SECRET or secrets.token_urlsafe(32)
+    server = WebhookServer(application, "127.0.0.1", 0, WEBHOOK_PATH, secret)
+    await server.start()
+
+    reader, writer = await asyncio.open_connection("127.0.0.1", server.port)
+    head = (f"POST {WEBHOOK_PATH} HTTP/1.1\r\nHost: 127.0.0.1\r\nContent-Type: application/json\r\n"
+            f"X-Telegram-Bot-Api-Secret-Token: {secret}\r\n")
+    statuses = Counter()
+    accept_times = []
+    started = time.perf_counter()
+    for body in updates:
+        sent_at = time.perf_counter()
+        writer.write(f"{head}Content-Length: {len(body)}\r\n\r\n".encode() + body)
+        await writer.drain()
+        statuses[int((await reader.readline()).split()[1])] += 1
+        while (await reader.readline()) not in (b"\r\n", b""):
+            pass
+        accept_times.append(time.perf_counter() - sent_at)
+    # Ждём, пока конвейер обработает всё принятое
+    await application.update_queue.join()
+    elapsed = time.perf_counter() - started
+
+    writer.close()
+    await server.stop()
+    await application.stop()
+    if application.post_stop:
+        await application.post_stop(application)
+    await application.shutdown()
+
+    accept_times.sort()
+    p50 = accept_times[len(accept_times) // 2] * 1000 if accept_times else 0
+    p95 = accept_times[int(len(accept_times) * 0.95)] * 1000 if accept_times else 0
+    calls = offline_request.calls if offline_request else Counter()
+    print(f"📨 Апдейтов: {len(updates)}, ответы вебхука: {dict(statuses)}")
+    print(f"⏱ До полной обработки: {elapsed:.3f} с ({len(updates) / elapsed:.0f} апдейтов/с)")
+    print(f"📥 Приём вебхуком: p50 {p50:.2f} мс, p95 {p95:.2f} мс")
+    print(f"📤 Вызовов Bot API: {sum(calls.values())} {dict(calls.most_common())}")
+
+
+# === Замер маршрутизации: python bot2.py --bench-routing ===
+def bench_routing(rounds: int = 20000):
+    """Время выбора обработчика на апдейт: прежняя цепочка Regex против ButtonRouter.
+
+    Сравнивается состояние VIEW_DISPLAY просмотра — самая длинная цепочка
+    кнопок. Цепочка Regex повторяет обработчики до перехода на ButtonRouter.
+    """
+    regex_chain = [
+        MessageHandler(filters.Regex("5|8"), view_display_builds),
+        MessageHandler(filters.Regex("➡ Следующая"), next_build),
+        MessageHandler(filters.Regex("⬅ Предыдущая"), previous_build),
+        MessageHandler(filters.Regex("📋 Сборки Warzone"), show_all_builds),
+        MessageHandler(filters.Regex("◀ Назад"), view_set_count),
+    ]
+    router = ButtonRouter({
+        "5": view_display_builds, "8": view_display_builds, "➡ Следующая": next_build,
+        "⬅ Предыдущая": previous_build, "📋 Сборки Warzone": show_all_builds, "◀ Назад": view_set_count,
+    })
+
+    def regex_pick(update):
+        for handler in regex_chain:
+            if handler.check_update(update):
+                return handler.callback
+        return None
+
+    def router_pick(update):
+        check = router.check_update(update)
+        return check[1] if check is not None else None
+
+    texts = ["5 (3)", "8 (0)", "➡ Следующая", "⬅ Предыдущая", "📋 Сборки Warzone", "◀ Назад", "MCW 6.8", "привет"]
+    print(f"{'Текст':<20} {'Regex, мкс':>11} {'Router, мкс':>12}  Regex → / Router →")
+    totals = [0.0, 0.0]
+    for n, text in enumerate(texts):
+        update = Update.de_json({"update_id": n, "message": {
+            "message_id": n, "date": 0, "chat": {"id": 1, "type": "private"},
+            "from": {"id": 1, "is_bot": False, "first_name": "bench"}, "text": text}}, app.bot)
+        timings = []
+        for pick in (regex_pick, router_pick):
+            started = time.perf_counter()
+            for _ in range(rounds):
+                pick(update)
+            timings.append((time.perf_counter() - started) / rounds * 1e6)
+        totals = [t + x for t, x in zip(totals, timings)]
+        chosen = [getattr(pick(update), "__name__", "—") for pick in (regex_pick, router_pick)]
+        print(f"{text:<20} {timings[0]:>11.2f} {timings[1]:>12.2f}  {chosen[0]} / {chosen[1]}")
+    print(f"{'В среднем':<20} {totals[0] / len(texts):>11.2f} {totals[1] / len(texts):>12.2f}")
+
+
+first_response_logged = False
+
+
+async def log_first_response(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Группа 1: срабатывает после того, как основные обработчики ответили
+    global first_response_logged
+    if first_response_logged:
+        return
+    first_response_logged = True
+    logging.info(f"⚡ Первый ответ через {(time.monotonic() - PROCESS_STARTED) * 1000:.0f} мс после запуска")
+
+
+# Запись входящих апдейтов для --replay
+async def record_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await run_io(_append_text, UPDATE_RECORD_PATH, json.dumps(update.to_dict(), ensure_ascii=False) + "\n")
+
+
+# === Маршрутизация кнопок: поиск по словарю вместо цепочки Regex ===
+def button_label(text: str) -> str:
+    """Текст кнопки без счётчика в конце: «5 (3)» → «5», «📈 Мета (2)» → «📈 Мета»."""
+    head, sep, tail = text.rpartition(" (")
+    if sep and tail.endswith(")") and tail[:-1].isdigit():
+        return head
+    return text
+
+
+class ButtonRouter(BaseHandler):
+    """Кнопки одного состояния: точный текст → обработчик за один поиск в словаре.
+
+    Если текст не совпал ни с одной кнопкой, по порядку проверяются обработчики
+    из fallback — для свободного ввода, в том числе с Regex. Подстрока кнопки
+    внутри другого текста (название оружия с цифрами и т.п.) больше не
+    срабатывает.
+    """
+
+    def __init__(self, routes: dict, fallback=(), block=True):
+        super().__init__(self._route, block=block)
+        self.routes = routes
+        self.fallback = tuple(fallback)
+
+    async def _route(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        return await self.routes[button_label(update.message.text)](update, context)
+
+    def check_update(self, update: object):
+        if not isinstance(update, Update):
+            return None
+        if update.message is not None and update.message.text is not None:
+            callback = self.routes.get(button_label(update.message.text))
+            if callback is not None:
+                return (None, callback)
+        for handler in self.fallback:
+            check = handler.check_update(update)
+            if check is not None and check is not False:
+                return (handler, check)
+        return None
+
+    async def handle_update(self, update, application, check_result, context):
+        # (None, callback) — кнопка; (обработчик, его check_update) — fallback
+        handler, check = check_result
+        if handler is None:
+            return await check(update, context)
+        return await handler.handle_update(update, application, check, context)
+
+
+async def confirmation_hint(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.message.reply_text(
+        "📍 Пожалуйста, нажмите кнопку «Завершить», чтобы сохранить сборку, или «Отмена», чтобы выйти.")
+
+
 # === Регистрация хендлеров ===
-app = ApplicationBuilder().token(TOKEN).post_init(on_startup).build()
+offline_request = OfflineRequest() if TELEGRAM_OFFLINE else None
+token = TOKEN or ("1:offline" if TELEGRAM_OFFLINE else None)
+rate_limiter = FloodControlRateLimiter(RATE_GLOBAL, RATE_PER_CHAT, RATE_CHAT_BURST, RATE_MAX_RETRIES, enabled=RATE_LIMIT)
+app_builder = (ApplicationBuilder().token(token).rate_limiter(rate_limiter)
+               .post_init(on_startup).post_stop(on_shutdown))
+if offline_request:
+    app_builder = app_builder.request(offline_request).get_updates_request(OfflineRequest())
+if PERSISTENCE_PATH:
+    app_builder = app_builder.persistence(SqlitePersistence(PERSISTENCE_PATH, PERSISTENCE_INTERVAL))
+if UPDATE_CONCURRENCY > 1:
+    app_builder = app_builder.concurrent_updates(PerUserUpdateProcessor(UPDATE_CONCURRENCY, MAX_PENDING_UPDATES))
+app = app_builder.build()
+
+app.add_handler(TypeHandler(Update, count_update), group=-2)
+if UPDATE_RECORD_PATH:
+    app.add_handler(TypeHandler(Update, record_update), group=-1)
+app.add_handler(TypeHandler(Update, log_first_response), group=1)
 
 
 app.add_handler(CommandHandler("start", start))
 app.add_handler(CommandHandler("restart", restart_bot))
+app.add_handler(CommandHandler("reload", reload_command))
 app.add_handler(CommandHandler("help", help_command))
 app.add_handler(CommandHandler("show_all", show_all_command))
 app.add_handler(CommandHandler("status", status_command))
 app.add_handler(CommandHandler("log", get_logs))
+app.add_handler(CommandHandler("loglevel", loglevel_command))
+app.add_handler(CommandHandler("logsample", logsample_command))
 app.add_handler(CommandHandler("check_files", check_files))
 
 
 
 add_conv = ConversationHandler(
+    name="add_conv",
+    persistent=bool(PERSISTENCE_PATH),
     entry_points=[
-        MessageHandler(filters.Regex("➕ Добавить сборку"), add_start),
+        ButtonRouter({"➕ Добавить сборку": add_start}),
         CommandHandler("add", add_start),
     ],
     states={
@@ -826,19 +4096,17 @@ add_conv = ConversationHandler(
         MODULE_SELECT: [
             MessageHandler(filters.TEXT & ~filters.COMMAND, select_modules),
             MessageHandler(filters.PHOTO | filters.Document.IMAGE, reject_early_image),
-            CallbackQueryHandler(module_variant_callback),
+            # Префикс mod: — чтобы кнопки карусели и списков (car:, page:) не попадали сюда
+            CallbackQueryHandler(module_variant_callback, pattern="^mod:"),
         ],
         IMAGE_UPLOAD: [MessageHandler(filters.PHOTO | filters.Document.IMAGE, handle_image)],
         CONFIRMATION: [
-            MessageHandler(filters.TEXT & filters.Regex("^Завершить$"), confirm_build),
-            MessageHandler(filters.Regex("Отмена"), cancel),
-            MessageHandler(filters.ALL & ~filters.COMMAND, lambda u, c: u.message.reply_text(
-                "📍 Пожалуйста, нажмите кнопку «Завершить», чтобы сохранить сборку, или «Отмена», чтобы выйти.")
-            )
+            ButtonRouter({"Завершить": confirm_build, "Отмена": cancel}, fallback=[
+                MessageHandler(filters.ALL & ~filters.COMMAND, confirmation_hint),
+            ]),
         ],
         POST_CONFIRM: [
-            MessageHandler(filters.Regex("➕ Добавить ещё одну сборку"), add_start),
-            MessageHandler(filters.Regex("◀ Отмена"), start)
+            ButtonRouter({"➕ Добавить ещё одну сборку": add_start, "◀ Отмена": start}),
         ],
     },
     fallbacks=[
@@ -856,7 +4124,9 @@ app.add_handler(add_conv)
 
 
 view_conv = ConversationHandler(
-    entry_points=[MessageHandler(filters.Regex("📋 Сборки Warzone"), view_category_select)],
+    name="view_conv",
+    persistent=bool(PERSISTENCE_PATH),
+    entry_points=[ButtonRouter({"📋 Сборки Warzone": view_category_select})],
     states={
         VIEW_CATEGORY_SELECT: [
             MessageHandler(filters.TEXT & ~filters.COMMAND, view_category_select),  # ← только view_category_select
@@ -864,16 +4134,20 @@ view_conv = ConversationHandler(
         VIEW_WEAPON: [MessageHandler(filters.TEXT & ~filters.COMMAND, view_select_weapon)],
         VIEW_SET_COUNT: [MessageHandler(filters.TEXT & ~filters.COMMAND, view_set_count)],
         VIEW_DISPLAY: [
-            MessageHandler(filters.Regex("5|8"), view_display_builds),
-            MessageHandler(filters.Regex("➡ Следующая"), next_build),
-            MessageHandler(filters.Regex("⬅ Предыдущая"), previous_build),
-            MessageHandler(filters.Regex("📋 Сборки Warzone"), show_all_builds),
-            MessageHandler(filters.Regex("◀ Назад"), view_set_count),
+            # «5 (N)» и «8 (N)» приходят со счётчиком, button_label его отрезает
+            ButtonRouter({
+                "5": view_display_builds,
+                "8": view_display_builds,
+                "➡ Следующая": next_build,
+                "⬅ Предыдущая": previous_build,
+                "📋 Сборки Warzone": show_all_builds,
+                "◀ Назад": view_set_count,
+            }),
         ]
     },
     fallbacks=[
         CommandHandler("home", home_command),
-        MessageHandler(filters.Regex("Отмена"), cancel),
+        ButtonRouter({"Отмена": cancel}),
     ]
 )
 
@@ -896,36 +4170,17 @@ async def delete_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("⛔ У вас нет доступа к этой команде.")
         return ConversationHandler.END
 
-    if not os.path.exists(DB_PATH):
+    if not build_repo.exists():
         await update.message.reply_text("❌ База сборок пуста.")
         return ConversationHandler.END
 
-    with open(DB_PATH, 'r') as f:
-        data = json.load(f)
+    text, keyboard = await render_list_page("del")
 
-    if not data:
+    if text is None:
         await update.message.reply_text("❌ Нет сборок для удаления.")
         return ConversationHandler.END
 
-    context.user_data['delete_map'] = {}
-    text_lines = ["🧾 Сборки для удаления:"]
-
-    for idx, b in enumerate(data, start=1):
-        context.user_data['delete_map'][str(idx)] = b
-        translation = load_translation_dict(b.get("type", ""))
-        modules = "\n".join(f"🔸 {k}: {translation.get(v, v)}" for k, v in b.get("modules", {}).items())
-        text_lines.append(
-        f"{b['weapon_name']} (ID {idx})\nТип: {b['type']}\n\nМодулей: {len(b['modules'])}\n{modules}\n\nАвтор: {b['author']}"
-    )
-
-    message = "\n\n".join(text_lines)
-    keyboard = InlineKeyboardMarkup.from_button(InlineKeyboardButton("🚪 Выйти из удаления", callback_data="stop_delete"))
-
-    await update.message.reply_text(
-        message + "\n\nВведите ID сборки для удаления (например: 1)",
-        parse_mode="HTML",
-        reply_markup=keyboard
-    )
+    await update.message.reply_text(text, parse_mode="HTML", reply_markup=keyboard)
     return DELETE_ENTER_ID
 
 # Callback-кнопка для выхода
@@ -936,13 +4191,14 @@ async def stop_delete_callback(update: Update, context: ContextTypes.DEFAULT_TYP
 
 # Ввод ID для удаления
 async def delete_enter_id(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    build_id = update.message.text.strip()
-    if build_id not in context.user_data.get('delete_map', {}):
+    text = update.message.text.strip()
+    b = await build_repo.get(int(text)) if text.isdigit() else None
+    if b is None:
         await update.message.reply_text("❌ Неверный ID. Попробуйте снова.")
         return DELETE_ENTER_ID
 
+    build_id = b['id']
     context.user_data['delete_id'] = build_id
-    b = context.user_data['delete_map'][build_id]
 
     await update.message.reply_text(
         f"❗ Вы уверены, что хотите удалить сборку {b['weapon_name']} (ID: {build_id})?",
@@ -956,24 +4212,18 @@ async def delete_confirm_simple(update: Update, context: ContextTypes.DEFAULT_TY
         await update.message.reply_text("❌ Отменено.")
         return await delete_start(update, context)
 
-    build_id = context.user_data.get('delete_id')
-    if not build_id or build_id not in context.user_data.get('delete_map', {}):
+    build_id = context.user_data.pop('delete_id', None)
+    if build_id is None or not await build_repo.remove(build_id):
         await update.message.reply_text("❌ Ошибка ID. Возврат к списку.")
         return await delete_start(update, context)
 
-    to_delete = context.user_data['delete_map'][build_id]
-    with open(DB_PATH, 'r') as f:
-        data = json.load(f)
-
-    new_data = [b for b in data if b != to_delete]
-    with open(DB_PATH, 'w') as f:
-        json.dump(new_data, f, indent=2)
-
     await update.message.reply_text("✅ Сборка удалена.")
     return await delete_start(update, context)
 
 # Handler
 simple_delete_conv = ConversationHandler(
+    name="simple_delete_conv",
+    persistent=bool(PERSISTENCE_PATH),
     entry_points=[CommandHandler("delete", delete_start)],
     states={
         DELETE_ENTER_ID: [
@@ -983,7 +4233,7 @@ simple_delete_conv = ConversationHandler(
     },
     fallbacks=[
         CommandHandler("home", home_command),
-        MessageHandler(filters.Regex("Отмена"), cancel), 
+        ButtonRouter({"Отмена": cancel}),
     ]
 )
 app.add_handler(simple_delete_conv)
@@ -992,47 +4242,28 @@ app.add_handler(simple_delete_conv)
 
 # отдельно за пределами ConversationHandler
 app.add_handler(CallbackQueryHandler(stop_delete_callback, pattern="^stop_delete$"))
+app.add_handler(CallbackQueryHandler(list_page_callback, pattern="^page:"))
+app.add_handler(CallbackQueryHandler(carousel_callback, pattern="^car:"))
 
 # Обработка кнопки главное меню
-app.add_handler(MessageHandler(filters.Regex("🏠 Главное меню"), start))
+app.add_handler(ButtonRouter({"🏠 Главное меню": start}))
 
 # ==================== КОНЕЦ удаления сборки ===================================== 
 
-def get_type_label_by_key(type_key):
-    try:
-        with open("database/types.json", "r", encoding="utf-8") as f:
-            types = json.load(f)
-            for t in types:
-                if t["key"] == type_key:
-                    return t["label"]
-    except Exception as e:
-        logging.warning(f"❌ Не удалось загрузить types.json: {e}")
-    return type_key  # fallback
-
-
-
-# === Загрузка переводов для отображения сборок ===
-def load_translation_dict(weapon_key):
-    file_map = {
-        "assault": "modules-assault.json",
-        "smg": "modules-pp.json",
-        "shotgun": "modules-drobovik.json",
-        "marksman": "modules-pehotnay.json",
-        "lmg": "modules-pulemet.json",
-        "sniper": "modules-snayperki.json",
-        # Добавь остальные при необходимости
-    }
-
-    filename = file_map.get(weapon_key)
-    if not filename:
-        return {}
-
-    with open(f"database/{filename}", "r", encoding="utf-8") as f:
-        raw_data = json.load(f)
-
-    return {v['en']: v['ru'] for variants in raw_data.values() for v in variants}
-
-
-
-
-app.run_polling()
+# Замер времени всех обработчиков основной группы (служебные группы -2/-1/1 не считаем)
+for handler in app.handlers[0]:
+    instrument_handler(handler)
+
+
+if __name__ == "__main__":
+    if "--migrate-sqlite" in sys.argv:
+        migrated = asyncio.run(migrate_json_to_sqlite())
+        print(f"✅ Перенесено сборок в {SQLITE_PATH}: {migrated}")
+    elif "--bench-routing" in sys.argv:
+        bench_routing()
+    elif "--replay" in sys.argv:
+        asyncio.run(replay_updates(app, sys.argv[sys.argv.index("--replay") + 1]))
+    elif BOT_MODE == "webhook":
+        asyncio.run(serve_webhook(app))
+    else:
+        app.run_polling()